@@ -0,0 +1,76 @@
+import statistics
+import time
+from pathlib import Path
+
+import fire
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+from manga_ocr import MangaOcr
+from manga_ocr.decoding import greedy_decode
+from manga_ocr.ocr import DECODING_SETTINGS
+
+IMAGES_ROOT = Path(__file__).parent.parent / "tests/data/images"
+
+
+def measure_decoding(
+    pretrained_model_name_or_path="kha-white/manga-ocr-base",
+    batch_sizes=(1, 16),
+    runs=5,
+    max_length=300,
+    force_cpu=True,
+    local_files_only=True,
+):
+    """
+    Measure per-token latency of decoding test images with transformers' generate(), with beam search and greedy,
+    and with greedy_decode. Encoder outputs are computed beforehand, so that only decoding is measured.
+
+    :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+    :param batch_sizes: Numbers of images decoded at once. Test images are repeated if there are fewer of them.
+    :param runs: Number of runs, median times are reported.
+    :param max_length: Maximum length of generated sequences.
+    :param force_cpu: Passed to MangaOcr.
+    :param local_files_only: Passed to MangaOcr. Model must be already downloaded if True.
+    """
+    mocr = MangaOcr(pretrained_model_name_or_path, force_cpu=force_cpu, local_files_only=local_files_only)
+    model = mocr.model
+    config = model.generation_config
+    paths = sorted(IMAGES_ROOT.iterdir())
+
+    methods = {
+        "generate_beam": lambda h: model.generate(
+            encoder_outputs=BaseModelOutput(last_hidden_state=h), max_length=max_length, **DECODING_SETTINGS["beam"]
+        ),
+        "generate_greedy": lambda h: model.generate(
+            encoder_outputs=BaseModelOutput(last_hidden_state=h), max_length=max_length, **DECODING_SETTINGS["greedy"]
+        ),
+        "greedy_decode": lambda h: greedy_decode(
+            mocr._decoder_step,
+            h,
+            config.decoder_start_token_id,
+            config.eos_token_id,
+            config.pad_token_id,
+            max_length,
+        ),
+    }
+
+    for batch_size in batch_sizes:
+        imgs = [mocr._read_image(paths[i % len(paths)]) for i in range(batch_size)]
+        hidden_states = mocr._encode(imgs)
+
+        for name, method in methods.items():
+            times = []
+            with torch.no_grad():
+                method(hidden_states)
+                for _ in range(runs):
+                    t0 = time.perf_counter()
+                    num_steps = method(hidden_states).shape[1] - 1
+                    times.append(time.perf_counter() - t0)
+            t = statistics.median(times)
+            print(
+                f"batch {batch_size:<4}{name:<18}{num_steps:>5} steps{t:>8.3f} s{1000 * t / num_steps:>8.2f} ms/token"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(measure_decoding)
@@ -0,0 +1,47 @@
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from manga_ocr import MangaOcr
+from tests.utils import TEST_DATA_ROOT, edit_distance
+
+
+def evaluate(mocr, expected_results):
+    errors = 0
+    num_chars = 0
+    num_exact = 0
+
+    t0 = time.time()
+    for item in expected_results:
+        result = mocr(TEST_DATA_ROOT / "images" / item["filename"])
+        errors += edit_distance(result, item["result"])
+        num_chars += len(item["result"])
+        num_exact += result == item["result"]
+    t1 = time.time()
+
+    return {
+        "cer": errors / num_chars,
+        "exact_match": num_exact / len(expected_results),
+        "latency": (t1 - t0) / len(expected_results),
+    }
+
+
+def quantization_report():
+    """
+    Compare accuracy and CPU latency of int8 quantized model with fp32 model on test data.
+    """
+    expected_results = json.loads((TEST_DATA_ROOT / "expected_results.json").read_text(encoding="utf-8"))
+
+    fp32 = evaluate(MangaOcr(force_cpu=True), expected_results)
+    int8 = evaluate(MangaOcr(quantize="int8"), expected_results)
+
+    print(f"{'':<12}{'fp32':>10}{'int8':>10}{'delta':>10}")
+    for key in ["cer", "exact_match", "latency"]:
+        print(f"{key:<12}{fp32[key]:>10.4f}{int8[key]:>10.4f}{int8[key] - fp32[key]:>+10.4f}")
+
+
+if __name__ == "__main__":
+    quantization_report()
@@ -0,0 +1,73 @@
+import io
+import sys
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from manga_ocr import MangaOcr
+from manga_ocr.detection import detect_text_regions
+from tests.utils import make_page
+
+
+def read_page_per_crop(mocr, page):
+    """
+    Baseline: detect text, then save every crop as an image file and run OCR on it separately,
+    as with a detector and the recognizer run as separate tools.
+    """
+    page = page.convert("L")
+    results = []
+    for box in detect_text_regions(np.asarray(page)):
+        f = io.BytesIO()
+        page.crop(box).save(f, format="PNG")
+        f.seek(0)
+        results.append({"box": box, "text": mocr(Image.open(f))})
+    return results
+
+
+def measure_read_page(
+    pretrained_model_name_or_path="kha-white/manga-ocr-base",
+    pages=5,
+    batch_size=16,
+    force_cpu=True,
+    local_files_only=True,
+):
+    """
+    Measure pages per second of MangaOcr.read_page, compared to running OCR for each detected crop separately.
+    Uses the synthetic page from tests.
+
+    :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+    :param pages: Number of pages to process with each method.
+    :param batch_size: Passed to read_page.
+    :param force_cpu: Passed to MangaOcr.
+    :param local_files_only: Passed to MangaOcr. Model must be already downloaded if True.
+    """
+    mocr = MangaOcr(pretrained_model_name_or_path, force_cpu=force_cpu, local_files_only=local_files_only)
+    page, _ = make_page()
+
+    t0 = time.perf_counter()
+    detect_text_regions(np.asarray(page))
+    print(f"{'detection':<12}{time.perf_counter() - t0:>8.3f} s")
+
+    methods = {
+        "read_page": lambda: mocr.read_page(page, batch_size=batch_size),
+        "per_crop": lambda: read_page_per_crop(mocr, page),
+    }
+    results = {}
+    for name, method in methods.items():
+        results[name] = method()
+        t0 = time.perf_counter()
+        for _ in range(pages):
+            method()
+        print(f"{name:<12}{pages / (time.perf_counter() - t0):>8.3f} pages/s")
+
+    if [r["text"] for r in results["read_page"]] != [r["text"] for r in results["per_crop"]]:
+        print("Warning: results differ")
+
+
+if __name__ == "__main__":
+    fire.Fire(measure_read_page)
@@ -0,0 +1,74 @@
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+import fire
+
+IMAGE_PATH = Path(__file__).parent.parent / "tests/data/images/00.jpg"
+
+# executed in a fresh interpreter, so that nothing is imported or initialized beforehand
+CHILD_CODE = """
+import json
+import time
+
+t0 = time.perf_counter()
+import manga_ocr
+t1 = time.perf_counter()
+from manga_ocr import MangaOcr
+t2 = time.perf_counter()
+mocr = MangaOcr({pretrained_model_name_or_path!r}, force_cpu=True, warmup={warmup!r}, local_files_only={local_files_only!r})
+t3 = time.perf_counter()
+mocr({image_path!r})
+t4 = time.perf_counter()
+
+print(json.dumps({{
+    "import_manga_ocr": t1 - t0,
+    "import_model_code": t2 - t1,
+    "load": t3 - t2,
+    "first_result": t4 - t3,
+    "total": t4 - t0,
+}}))
+"""
+
+
+def cold_start(pretrained_model_name_or_path, runs=3, warmup=False, local_files_only=True):
+    """
+    Return median times in seconds of import, model load and the first result, from runs in fresh Python processes.
+    """
+    code = CHILD_CODE.format(
+        pretrained_model_name_or_path=str(pretrained_model_name_or_path),
+        warmup=warmup,
+        local_files_only=local_files_only,
+        image_path=str(IMAGE_PATH),
+    )
+
+    results = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.splitlines()[-1]))
+    return {key: statistics.median(r[key] for r in results) for key in results[0]}
+
+
+def measure_startup(
+    pretrained_model_name_or_path="kha-white/manga-ocr-base",
+    runs=3,
+    warmup=False,
+    local_files_only=True,
+):
+    """
+    Measure cold start time of MangaOcr on CPU: import time, model load time and time to the first result.
+    Each run is done in a fresh Python process.
+
+    :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+    :param runs: Number of runs, median times are reported.
+    :param warmup: Passed to MangaOcr, either True, False or "background".
+    :param local_files_only: Passed to MangaOcr. Model must be already downloaded if True.
+    """
+    for key, t in cold_start(pretrained_model_name_or_path, runs, warmup, local_files_only).items():
+        print(f"{key:<20}{t:>8.3f} s")
+
+
+if __name__ == "__main__":
+    fire.Fire(measure_startup)
@@ -0,0 +1,214 @@
+import json
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from startup import cold_start
+
+from manga_ocr import MangaOcr, __version__
+
+IMAGES_ROOT = Path(__file__).parent.parent / "tests/data/images"
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+
+# test images with a single column of vertical text, used as building blocks of synthetic crops
+COLUMN_IMAGES = ["06.jpg", "08.jpg", "09.jpg"]
+
+# name -> (number of text columns, height in pixels)
+SYNTHETIC_CROPS = {
+    "short": (1, 96),
+    "medium": (3, 256),
+    "long": (6, 512),
+}
+
+
+def make_crop(num_columns, height):
+    """
+    Synthetic crop of a text balloon with a given number of columns of vertical text, made of test images
+    resized to a given height and placed from right to left, as in manga.
+    """
+    columns = []
+    for i in range(num_columns):
+        img = Image.open(IMAGES_ROOT / COLUMN_IMAGES[i % len(COLUMN_IMAGES)]).convert("L")
+        columns.append(img.resize((round(img.width * height / img.height), height), Image.Resampling.BICUBIC))
+
+    margin = height // 16
+    crop = Image.new("L", (sum(img.width + margin for img in columns) + margin, height + 2 * margin), 255)
+    x = crop.width
+    for img in columns:
+        x -= img.width + margin
+        crop.paste(img, (x, margin))
+    return crop
+
+
+def latency(mocr, imgs, runs):
+    """
+    Return p50/p95/p99 latency in milliseconds of recognizing single images, cycling through imgs.
+    """
+    mocr(imgs[0])
+    times = []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        mocr(imgs[i % len(imgs)])
+        times.append(time.perf_counter() - t0)
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000
+    return {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+
+
+def throughput(mocr, imgs, batch_size):
+    """
+    Return images per second of recognizing imgs in batches.
+    """
+    mocr.batch(imgs[:batch_size], batch_size=batch_size)
+    t0 = time.perf_counter()
+    mocr.batch(imgs, batch_size=batch_size)
+    return len(imgs) / (time.perf_counter() - t0)
+
+
+def compare(results, baseline, tolerance, min_difference_secs=0.001):
+    """
+    Compare metrics with a baseline. Metrics ending with "_per_s" are better when higher, others are times, better
+    when lower. Differences of times below min_difference_secs are never regressions, as they're mostly noise.
+    Returns a list of (name, baseline value, new value, relative change, whether it's a regression).
+    """
+    rows = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        change = (value - old) / old if old else 0.0
+        if name.endswith("_per_s"):
+            regression = -change > tolerance
+        else:
+            secs = value - old if name.endswith("_s") else (value - old) / 1000
+            regression = change > tolerance and secs > min_difference_secs
+        rows.append((name, old, value, change, regression))
+    return rows
+
+
+def run_benchmarks(
+    pretrained_model_name_or_path="kha-white/manga-ocr-base",
+    decoding="beam",
+    latency_runs=50,
+    batch_sizes=(1, 4, 16),
+    num_threads=(1, 2, 4),
+    num_images=48,
+    cold_start_runs=3,
+    output="benchmark_results.json",
+    baseline=str(BASELINE_PATH),
+    save_baseline=False,
+    tolerance=0.15,
+    local_files_only=True,
+):
+    """
+    Measure performance of MangaOcr on CPU: cold start, single-image latency on test images and on synthetic crops
+    of different sizes and text lengths, and throughput of batches with different numbers of threads.
+    Results are saved as JSON and compared with a baseline saved before, e.g. from the last release, measured
+    on the same machine. Exits with status 1 if any metric got worse by more than tolerance.
+
+    :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+    :param decoding: Passed to MangaOcr.
+    :param latency_runs: Number of images recognized for each latency measurement.
+    :param batch_sizes: Batch sizes to measure throughput with.
+    :param num_threads: Numbers of torch threads to measure throughput with. Numbers above CPU count are skipped.
+    :param num_images: Number of images recognized for each throughput measurement.
+    :param cold_start_runs: Number of fresh Python processes to measure cold start in, 0 to skip it.
+    :param output: Path to save results to.
+    :param baseline: Path to results to compare with, skipped if the file doesn't exist.
+    :param save_baseline: If True, also save results as the new baseline.
+    :param tolerance: Relative change of a metric for the worse, which is reported as a regression.
+    :param local_files_only: Passed to MangaOcr. Model must be already downloaded if True.
+    """
+    metrics = {}
+    if cold_start_runs > 0:
+        for key, t in cold_start(pretrained_model_name_or_path, cold_start_runs, False, local_files_only).items():
+            metrics[f"cold_start.{key}_s"] = t
+
+    mocr = MangaOcr(
+        pretrained_model_name_or_path,
+        force_cpu=True,
+        warmup=False,
+        local_files_only=local_files_only,
+        decoding=decoding,
+    )
+    test_images = [Image.open(path).convert("L") for path in sorted(IMAGES_ROOT.iterdir())]
+    image_sets = {"test_images": test_images}
+    for name, (num_columns, height) in SYNTHETIC_CROPS.items():
+        image_sets[f"synthetic_{name}"] = [make_crop(num_columns, height)]
+
+    for name, imgs in image_sets.items():
+        for key, t in latency(mocr, imgs, latency_runs).items():
+            metrics[f"latency.{name}.{key}"] = t
+
+    default_num_threads = torch.get_num_threads()
+    imgs = [test_images[i % len(test_images)] for i in range(num_images)]
+    try:
+        for n in num_threads:
+            if n > os.cpu_count():
+                continue
+            torch.set_num_threads(n)
+            for batch_size in batch_sizes:
+                metrics[f"throughput.threads_{n}.batch_{batch_size}.images_per_s"] = throughput(mocr, imgs, batch_size)
+    finally:
+        torch.set_num_threads(default_num_threads)
+
+    results = {
+        "environment": {
+            "manga_ocr": __version__,
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": default_num_threads,
+        },
+        "settings": {
+            "model": str(pretrained_model_name_or_path),
+            "decoding": decoding,
+            "latency_runs": latency_runs,
+            "num_images": num_images,
+        },
+        "metrics": metrics,
+    }
+    for name, value in metrics.items():
+        print(f"{name:<48}{value:>10.3f}")
+
+    Path(output).write_text(json.dumps(results, indent=2))
+    print(f"Results saved to {output}")
+    if save_baseline:
+        Path(baseline).write_text(json.dumps(results, indent=2))
+        print(f"Baseline saved to {baseline}")
+        return
+
+    if not Path(baseline).is_file():
+        print(f"No baseline found at {baseline}, run with --save_baseline to create it")
+        return
+    baseline_results = json.loads(Path(baseline).read_text())
+    # the version is expected to differ, when comparing with a previous release
+    environment = {key: value for key, value in results["environment"].items() if key != "manga_ocr"}
+    if {key: value for key, value in baseline_results["environment"].items() if key != "manga_ocr"} != environment:
+        print("Warning: baseline was measured in a different environment:", baseline_results["environment"])
+    if baseline_results["settings"] != results["settings"]:
+        print("Warning: baseline was measured with different settings:", baseline_results["settings"])
+
+    rows = compare(metrics, baseline_results["metrics"], tolerance)
+    print(f"\n{'metric':<48}{'baseline':>10}{'new':>10}{'change':>9}")
+    for name, old, new, change, regression in rows:
+        print(f"{name:<48}{old:>10.3f}{new:>10.3f}{change:>+9.1%}{'  REGRESSION' if regression else ''}")
+
+    regressions = [row[0] for row in rows if row[4]]
+    if regressions:
+        print(f"{len(regressions)} metrics got worse by more than {tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(run_benchmarks)
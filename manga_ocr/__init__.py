@@ -1,2 +1,13 @@
 from ._version import __version__ as __version__
-from manga_ocr.ocr import MangaOcr as MangaOcr
+
+
+def __getattr__(name):
+    # import the model code, and with it torch and transformers, only when it's actually used
+    if name == "MangaOcr":
+        from manga_ocr.ocr import MangaOcr
+
+        return MangaOcr
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["MangaOcr", "__version__"]
@@ -1,10 +1,17 @@
+import sys
+
 import fire
 
 from manga_ocr.run import run
 
 
 def main():
-    fire.Fire(run)
+    if sys.argv[1:2] == ["serve"]:
+        from manga_ocr.server import serve
+
+        fire.Fire(serve, command=sys.argv[2:], name="manga_ocr serve")
+    else:
+        fire.Fire(run)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+class AsyncBatcher:
+    """
+    Gathers images awaited concurrently in an event loop into shared batches, recognized by MangaOcr's inference
+    thread. A batch starts as soon as the previous one finishes, with all images which arrived meanwhile, up to
+    batch_size, so that no time is spent waiting for a batch to fill up.
+    """
+
+    def __init__(self, mocr, loop, batch_size=16):
+        """
+        :param mocr: MangaOcr instance.
+        :param loop: Event loop, in which results are awaited.
+        :param batch_size: Maximum number of images recognized at once.
+        """
+        self.mocr = mocr
+        self.loop = loop
+        self.batch_size = batch_size
+        self.pending = []
+        self.running = False
+
+    def submit(self, img):
+        """
+        Queue a loaded image and return a future of its text. Cancelled futures are skipped, if they haven't been
+        recognized yet.
+        """
+        future = self.loop.create_future()
+        self.pending.append((img, future))
+        if not self.running:
+            self.running = True
+            # start on the next iteration of the loop, so that images submitted together share the first batch
+            self.loop.call_soon(self._start_batch)
+        return future
+
+    def _start_batch(self):
+        items = []
+        while self.pending and len(items) < self.batch_size:
+            img, future = self.pending.pop(0)
+            if not future.cancelled():
+                items.append((img, future))
+
+        if not items:
+            self.running = False
+            return
+
+        imgs = [img for img, _ in items]
+        task = self.loop.run_in_executor(self.mocr._executor, self.mocr._recognize, imgs, {})
+        task.add_done_callback(lambda task: self._finish_batch(items, task))
+
+    def _finish_batch(self, items, task):
+        if task.exception() is not None:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(task.exception())
+        else:
+            for (_, future), text in zip(items, task.result()):
+                if not future.done():
+                    future.set_result(text)
+        self._start_batch()
@@ -0,0 +1,158 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from transformers.utils import cached_file
+from transformers.utils.hub import extract_commit_hash
+
+
+def model_revision(pretrained_model_name_or_path):
+    """
+    Version of a model: the newest mtime of files of a local model, or the commit hash of a model from the hub,
+    as resolved by its last download. None if it can't be determined.
+    """
+    path = Path(pretrained_model_name_or_path)
+    if path.is_dir():
+        return str(max(f.stat().st_mtime_ns for f in path.iterdir()))
+    try:
+        config_path = cached_file(str(pretrained_model_name_or_path), "config.json", local_files_only=True)
+    except OSError:
+        return None
+    return extract_commit_hash(config_path, None)
+
+
+def model_fingerprint(pretrained_model_name_or_path, backend="torch", quantize=None):
+    """
+    Hash of everything about a model which affects its results, used as a prefix of cache keys.
+    """
+    model_id = [str(pretrained_model_name_or_path), model_revision(pretrained_model_name_or_path), backend, quantize]
+    return hashlib.blake2b(repr(model_id).encode(), digest_size=8).hexdigest()
+
+
+class OcrCache:
+    """
+    Content-addressed cache of OCR results, keyed by a hash of the preprocessed grayscale image. MangaOcr prefixes
+    keys with model_fingerprint, so that a cache, or its database, can be shared by different models.
+
+    Recognized texts and, optionally, encoder hidden states are kept in memory with LRU eviction within max_bytes.
+    If path is given, texts are also stored in an sqlite database, which persists between runs.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, path=None, keep_encoder_outputs=False):
+        self.max_bytes = max_bytes
+        self.keep_encoder_outputs = keep_encoder_outputs
+        self.hits = 0
+        self.misses = 0
+        self.encoder_hits = 0
+        self.encoder_misses = 0
+
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+        self._db = None
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS texts (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+            self._db.commit()
+
+    @staticmethod
+    def image_key(img):
+        """
+        Key of a PIL image, or of a (height, width) uint8 array, which gets the same key as the same grayscale image.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        if isinstance(img, np.ndarray):
+            h.update(f"L:{img.shape[1]}x{img.shape[0]}:".encode())
+            h.update(np.ascontiguousarray(img).data)
+        else:
+            h.update(f"{img.mode}:{img.width}x{img.height}:".encode())
+            h.update(img.tobytes())
+        return h.hexdigest()
+
+    def get_text(self, key):
+        with self._lock:
+            text = self._get(("text", key))
+            if text is None and self._db is not None:
+                row = self._db.execute("SELECT text FROM texts WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    text = row[0]
+                    self._put(("text", key), text, len(text.encode("utf-8")))
+
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return text
+
+    def put_text(self, key, text):
+        with self._lock:
+            self._put(("text", key), text, len(text.encode("utf-8")))
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO texts (key, text) VALUES (?, ?)", (key, text))
+                self._db.commit()
+
+    def get_encoder_outputs(self, key):
+        if not self.keep_encoder_outputs:
+            return None
+
+        with self._lock:
+            hidden_states = self._get(("encoder", key))
+            if hidden_states is None:
+                self.encoder_misses += 1
+            else:
+                self.encoder_hits += 1
+            return hidden_states
+
+    def put_encoder_outputs(self, key, hidden_states):
+        if not self.keep_encoder_outputs:
+            return
+
+        with self._lock:
+            self._put(("encoder", key), hidden_states, hidden_states.numel() * hidden_states.element_size())
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "encoder_hits": self.encoder_hits,
+            "encoder_misses": self.encoder_misses,
+            "entries": len(self._entries),
+            "bytes": self._num_bytes,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _get(self, entry_key):
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(entry_key)
+        return entry[0]
+
+    def _put(self, entry_key, value, num_bytes):
+        if num_bytes > self.max_bytes:
+            return
+
+        old = self._entries.pop(entry_key, None)
+        if old is not None:
+            self._num_bytes -= old[1]
+
+        self._entries[entry_key] = (value, num_bytes)
+        self._num_bytes += num_bytes
+
+        while self._num_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self._num_bytes -= evicted_bytes
@@ -0,0 +1,413 @@
+import torch
+from torch import nn
+
+
+class BertDecoderStep(nn.Module):
+    """
+    Single decoding step of the BERT decoder of a VisionEncoderDecoderModel, written with explicit key/value tensors
+    instead of transformers' cache classes, so that it can be exported to ONNX and run in a custom decoding loop.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.enc_to_dec_proj = getattr(model, "enc_to_dec_proj", None)
+        self.embeddings = model.decoder.bert.embeddings
+        self.layers = model.decoder.bert.encoder.layer
+        self.lm_head = model.decoder.cls
+        self.num_heads = self.layers[0].attention.self.num_attention_heads
+        self.head_size = self.layers[0].attention.self.attention_head_size
+
+    def cross_attention_kv(self, encoder_hidden_states):
+        """
+        Compute cross-attention keys and values of all layers, which stay constant for the whole decoding.
+        """
+        if self.enc_to_dec_proj is not None:
+            encoder_hidden_states = self.enc_to_dec_proj(encoder_hidden_states)
+
+        cross_kv = []
+        for layer in self.layers:
+            attention = layer.crossattention.self
+            cross_kv.append(self._split_heads(attention.key(encoder_hidden_states)))
+            cross_kv.append(self._split_heads(attention.value(encoder_hidden_states)))
+        return cross_kv
+
+    def forward(self, input_ids, position_ids, cross_kv, past_kv):
+        """
+        Run the decoder on the last generated token of each sequence.
+
+        :param input_ids: (batch, 1) last generated tokens.
+        :param position_ids: (batch, 1) positions of these tokens.
+        :param cross_kv: list of cross-attention keys and values, as returned by cross_attention_kv.
+        :param past_kv: list of self-attention keys and values of previous tokens, (batch, heads, past, head_size).
+        :return: next token logits (batch, vocab) and self-attention keys and values including the current token.
+        """
+        hidden_states = self.embeddings(input_ids=input_ids, position_ids=position_ids)
+
+        present_kv = []
+        for i, layer in enumerate(self.layers):
+            attention = layer.attention.self
+            key = torch.cat([past_kv[2 * i], self._split_heads(attention.key(hidden_states))], dim=2)
+            value = torch.cat([past_kv[2 * i + 1], self._split_heads(attention.value(hidden_states))], dim=2)
+            present_kv += [key, value]
+            hidden_states = self._layer(layer, hidden_states, key, value, cross_kv[2 * i], cross_kv[2 * i + 1])
+
+        logits = self.lm_head(hidden_states)[:, -1]
+        return logits, present_kv
+
+    def forward_cached(self, input_ids, positions, cross_kv, kv_cache):
+        """
+        Same as forward, but keys and values of the current tokens are written in place into kv_cache,
+        preallocated for all positions, instead of being concatenated with the past ones.
+
+        :param input_ids: (batch, length) tokens, usually just the last generated one, or several to be checked at once.
+        :param positions: Position of the first of input_ids, either an int, if it's the same for the whole batch,
+            or a (batch,) tensor. Keys and values cached after it are overwritten or ignored.
+        :param cross_kv: list of cross-attention keys and values, as returned by cross_attention_kv.
+        :param kv_cache: list of self-attention keys and values, (batch, heads, max_length, head_size).
+        :return: next token logits (batch, length, vocab).
+        """
+        batch_size, length = input_ids.shape
+        offsets = torch.arange(length, device=input_ids.device)
+        if isinstance(positions, int):
+            position_ids = (positions + offsets).expand(batch_size, length)
+            end = positions + length
+        else:
+            position_ids = positions[:, None] + offsets
+            end = int(position_ids.max()) + 1
+
+        # each token attends to itself and to cached tokens before it in its row
+        mask = None
+        if length > 1 or not isinstance(positions, int):
+            mask = (torch.arange(end, device=input_ids.device) <= position_ids[:, :, None])[:, None]
+
+        hidden_states = self.embeddings(input_ids=input_ids, position_ids=position_ids)
+
+        for i, layer in enumerate(self.layers):
+            attention = layer.attention.self
+            key, value = kv_cache[2 * i], kv_cache[2 * i + 1]
+            new_key = self._split_heads(attention.key(hidden_states))
+            new_value = self._split_heads(attention.value(hidden_states))
+            if isinstance(positions, int):
+                key[:, :, positions:end] = new_key
+                value[:, :, positions:end] = new_value
+            else:
+                rows = torch.arange(batch_size, device=input_ids.device)[:, None]
+                key[rows, :, position_ids] = new_key.transpose(1, 2)
+                value[rows, :, position_ids] = new_value.transpose(1, 2)
+            hidden_states = self._layer(
+                layer, hidden_states, key[:, :, :end], value[:, :, :end], cross_kv[2 * i], cross_kv[2 * i + 1], mask
+            )
+
+        return self.lm_head(hidden_states)
+
+    def _layer(self, layer, hidden_states, key, value, cross_key, cross_value, mask=None):
+        x = self._attend(layer.attention.self.query(hidden_states), key, value, mask)
+        hidden_states = layer.attention.output(x, hidden_states)
+
+        x = self._attend(layer.crossattention.self.query(hidden_states), cross_key, cross_value)
+        hidden_states = layer.crossattention.output(x, hidden_states)
+
+        return layer.output(layer.intermediate(hidden_states), hidden_states)
+
+    def _split_heads(self, x):
+        return x.view(x.shape[0], -1, self.num_heads, self.head_size).transpose(1, 2)
+
+    def _attend(self, query, key, value, mask=None):
+        query = self._split_heads(query)
+        scores = query @ key.transpose(-1, -2) * self.head_size**-0.5
+        if mask is not None:
+            scores = scores.masked_fill(~mask, -float("inf"))
+            # masked weights are 0, but 0 * nan isn't, so values of slots no token of a row attends to are zeroed
+            value = value.masked_fill(~mask.any(dim=2)[..., None], 0)
+        weights = torch.softmax(scores, dim=-1)
+        x = (weights @ value).transpose(1, 2)
+        return x.reshape(x.shape[0], x.shape[1], -1)
+
+
+@torch.no_grad()
+def greedy_decode(
+    step,
+    encoder_hidden_states,
+    decoder_start_token_id,
+    eos_token_id,
+    pad_token_id,
+    max_length=300,
+    drafts=None,
+    step_callback=None,
+    max_batch_size=None,
+):
+    """
+    Minimal greedy decoding with a BertDecoderStep, without any logits processors. Gives the same results as
+    transformers' generate() with num_beams=1 and no other settings.
+
+    Cross-attention keys and values are computed once, and self-attention ones are written into a cache preallocated
+    for max_length tokens. Rows which generated eos_token_id are removed from the batch, so that they don't take
+    any time in the following steps.
+
+    With max_batch_size, at most that many rows are decoded at once, and each row which finished frees its slot
+    in the batch for the next waiting one (continuous batching), so that the batch stays full until no rows are
+    waiting, instead of shrinking while its longest text is finishing.
+
+    Drafts, expected token ids of each row after decoder_start_token_id (e.g. the result for a slightly different
+    image, tokens from eos_token_id on are ignored), are checked in a single
+    decoder pass over all of their tokens. Decoding continues one token at a time only after the longest prefix of
+    a draft, which greedy decoding would generate too, so if a draft is right, the row is done in one step.
+    Results don't depend on drafts.
+
+    Optional step_callback is called after every decoder pass with the (batch_size, max_length) tensor of tokens
+    decoded so far, padded with pad_token_id, e.g. to measure time of steps or to stream results. The tensor is
+    updated in place by the following steps.
+
+    Returns a (batch_size, length) tensor of token ids, starting with decoder_start_token_id and padded with
+    pad_token_id after eos_token_id.
+    """
+    batch_size = encoder_hidden_states.shape[0]
+    device = encoder_hidden_states.device
+    num_slots = batch_size if max_batch_size is None else min(max_batch_size, batch_size)
+
+    sequences = torch.full((batch_size, max_length), pad_token_id, dtype=torch.long, device=device)
+    sequences[:, 0] = decoder_start_token_id
+    lengths = torch.ones(batch_size, dtype=torch.long, device=device)
+    if drafts is not None:
+        drafts = [draft[: draft.index(eos_token_id)] if eos_token_id in draft else draft for draft in map(list, drafts)]
+
+    # rows[i] is the row decoded in the i-th slot of the batch
+    rows = torch.arange(num_slots, device=device)
+    cross_kv = step.cross_attention_kv(encoder_hidden_states[rows])
+    kv_cache = [x.new_zeros(num_slots, step.num_heads, max_length, step.head_size) for x in cross_kv]
+    if drafts is not None and max_length > 2:
+        _accept_drafts(step, rows, drafts, sequences, lengths, cross_kv, kv_cache)
+        if step_callback is not None:
+            step_callback(sequences)
+    next_row = num_slots
+    # without drafts or refilled slots, all rows are at the same position
+    same_position = drafts is None
+
+    while True:
+        last_tokens = sequences[rows, lengths[rows] - 1]
+        unfinished = (last_tokens != eos_token_id) & (lengths[rows] < max_length)
+        if not unfinished.all():
+            free_slots = (~unfinished).nonzero()[:, 0][: batch_size - next_row]
+            if len(free_slots):
+                new_rows = torch.arange(next_row, next_row + len(free_slots), device=device)
+                next_row += len(free_slots)
+                rows[free_slots] = new_rows
+                for x, new in zip(cross_kv, step.cross_attention_kv(encoder_hidden_states[new_rows])):
+                    x[free_slots] = new
+                # without drafts, keys and values cached by the previous row of a slot are overwritten by the new row
+                # before it attends to them
+                if drafts is not None and max_length > 2:
+                    new_cross_kv = [x[free_slots] for x in cross_kv]
+                    new_kv_cache = [x.new_zeros(len(new_rows), *x.shape[1:]) for x in kv_cache]
+                    _accept_drafts(step, new_rows, drafts, sequences, lengths, new_cross_kv, new_kv_cache)
+                    for x, new in zip(kv_cache, new_kv_cache):
+                        x[free_slots] = new
+                    if step_callback is not None:
+                        step_callback(sequences)
+                same_position = False
+                # rows with drafts may be finished already
+                continue
+
+            if not unfinished.any():
+                break
+            rows, last_tokens = rows[unfinished], last_tokens[unfinished]
+            cross_kv = [x[unfinished] for x in cross_kv]
+            kv_cache = [x[unfinished] for x in kv_cache]
+
+        positions = lengths[rows] - 1
+        logits = step.forward_cached(
+            last_tokens[:, None], int(positions[0]) if same_position else positions, cross_kv, kv_cache
+        )
+        sequences[rows, positions + 1] = logits[:, -1].argmax(dim=-1)
+        lengths[rows] += 1
+        if step_callback is not None:
+            step_callback(sequences)
+
+    return sequences[:, : int(lengths.max())]
+
+
+def _accept_drafts(step, rows, drafts, sequences, lengths, cross_kv, kv_cache):
+    """
+    Run the decoder once over start tokens followed by drafts of rows, and append to their sequences the longest
+    prefix of each draft, which matches tokens predicted by the decoder, followed by the next predicted token,
+    in place. cross_kv and kv_cache are those of rows only.
+    """
+    max_length = sequences.shape[1]
+    drafts = [drafts[i][: max_length - 2] for i in rows.tolist()]
+    draft_lengths = torch.tensor([len(draft) for draft in drafts], device=sequences.device)
+    width = 1 + int(draft_lengths.max())
+
+    input_ids = sequences[rows, :width]
+    for i, draft in enumerate(drafts):
+        input_ids[i, 1 : 1 + len(draft)] = torch.tensor(draft, dtype=torch.long)
+    predicted = step.forward_cached(input_ids, 0, cross_kv, kv_cache).argmax(dim=-1)
+
+    is_draft = torch.arange(width - 1, device=sequences.device) < draft_lengths[:, None]
+    num_accepted = ((predicted[:, :-1] == input_ids[:, 1:]) & is_draft).long().cumprod(dim=1).sum(dim=1)
+
+    is_accepted = torch.arange(width - 1, device=sequences.device) < num_accepted[:, None]
+    sequences[rows, 1:width] = torch.where(is_accepted, input_ids[:, 1:], sequences[rows, 1:width])
+    sequences[rows, num_accepted + 1] = predicted[torch.arange(len(rows), device=sequences.device), num_accepted]
+    lengths[rows] = num_accepted + 2
+
+
+def generate(
+    decoder,
+    batch_size,
+    decoder_start_token_id,
+    eos_token_id,
+    pad_token_id,
+    max_length=300,
+    num_beams=1,
+    no_repeat_ngram_size=0,
+    length_penalty=1.0,
+    early_stopping=False,
+    **kwargs,
+):
+    """
+    Greedy or beam search over a decoder exposing step(input_ids, position) -> logits and reorder(indices),
+    following the semantics of transformers' generate(), so that results match it for the same settings.
+    Returns a (batch_size, length) tensor of token ids, starting with decoder_start_token_id.
+    """
+    if num_beams == 1:
+        return _greedy_search(
+            decoder, batch_size, decoder_start_token_id, eos_token_id, pad_token_id, max_length, no_repeat_ngram_size
+        )
+
+    return _beam_search(
+        decoder,
+        batch_size,
+        decoder_start_token_id,
+        eos_token_id,
+        pad_token_id,
+        max_length,
+        num_beams,
+        no_repeat_ngram_size,
+        length_penalty,
+        early_stopping,
+    )
+
+
+def _greedy_search(
+    decoder, batch_size, decoder_start_token_id, eos_token_id, pad_token_id, max_length, no_repeat_ngram_size
+):
+    sequences = torch.full((batch_size, 1), decoder_start_token_id, dtype=torch.long)
+    unfinished = torch.ones(batch_size, dtype=torch.bool)
+
+    while sequences.shape[1] < max_length:
+        logits = decoder.step(sequences[:, -1:], sequences.shape[1] - 1).float().cpu()
+        _ban_repeated_ngrams(logits, sequences, no_repeat_ngram_size)
+
+        next_tokens = torch.where(unfinished, logits.argmax(dim=-1), pad_token_id)
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=1)
+
+        unfinished &= next_tokens != eos_token_id
+        if not unfinished.any():
+            break
+
+    return sequences
+
+
+def _beam_search(
+    decoder,
+    batch_size,
+    decoder_start_token_id,
+    eos_token_id,
+    pad_token_id,
+    max_length,
+    num_beams,
+    no_repeat_ngram_size,
+    length_penalty,
+    early_stopping,
+):
+    beams_to_keep = 2 * num_beams
+    top_num_beam_mask = torch.arange(beams_to_keep) < num_beams
+    batch_offset = torch.arange(batch_size)[:, None] * num_beams
+
+    running_sequences = torch.full((batch_size, num_beams, max_length), pad_token_id, dtype=torch.long)
+    running_sequences[:, :, 0] = decoder_start_token_id
+    sequences = running_sequences.clone()
+    lengths = torch.ones(batch_size, num_beams, dtype=torch.long)
+
+    # only the first beam is used at the first step, to avoid selecting the same tokens on every beam
+    running_scores = torch.zeros(batch_size, num_beams)
+    running_scores[:, 1:] = -1e9
+    scores = torch.full((batch_size, num_beams), -1e9)
+    is_finished = torch.zeros(batch_size, num_beams, dtype=torch.bool)
+    can_improve = torch.ones(batch_size, 1, dtype=torch.bool)
+
+    decoder.reorder(torch.arange(batch_size).repeat_interleave(num_beams))
+
+    cur_len = 1
+    while True:
+        flat_sequences = running_sequences[:, :, :cur_len].reshape(batch_size * num_beams, cur_len)
+        logits = decoder.step(flat_sequences[:, -1:], cur_len - 1).float().cpu()
+        log_probs = torch.log_softmax(logits, dim=-1)
+        _ban_repeated_ngrams(log_probs, flat_sequences, no_repeat_ngram_size)
+
+        vocab_size = log_probs.shape[-1]
+        log_probs = log_probs.view(batch_size, num_beams, vocab_size) + running_scores[:, :, None]
+        topk_scores, topk_indices = torch.topk(log_probs.view(batch_size, -1), k=beams_to_keep)
+        topk_beams = topk_indices // vocab_size
+        topk_sequences = torch.gather(running_sequences, 1, topk_beams[:, :, None].expand(-1, -1, max_length))
+        topk_sequences[:, :, cur_len] = topk_indices % vocab_size
+
+        hits_stop = (topk_sequences[:, :, cur_len] == eos_token_id) | (cur_len + 1 >= max_length)
+
+        # continue with the best num_beams sequences which did not finish
+        topk_running_scores = topk_scores + hits_stop.float() * -1e9
+        next_indices = torch.topk(topk_running_scores, k=num_beams)[1]
+        running_sequences = torch.gather(topk_sequences, 1, next_indices[:, :, None].expand(-1, -1, max_length))
+        running_scores = torch.gather(topk_running_scores, 1, next_indices)
+        beam_idx = torch.gather(topk_beams, 1, next_indices) + batch_offset
+
+        # update finished hypotheses with the best of the ones which just finished
+        just_finished = hits_stop & top_num_beam_mask[None, :]
+        finished_scores = topk_scores / (cur_len**length_penalty)
+        if early_stopping is True:
+            finished_scores += is_finished.all(dim=-1, keepdim=True).float() * -1e9
+        finished_scores += (~can_improve).float() * -1e9
+        finished_scores += (~just_finished).float() * -1e9
+
+        merged_sequences = torch.cat([sequences, topk_sequences], dim=1)
+        merged_scores = torch.cat([scores, finished_scores], dim=1)
+        merged_lengths = torch.cat([lengths, torch.full_like(topk_scores, cur_len + 1, dtype=torch.long)], dim=1)
+        merged_is_finished = torch.cat([is_finished, just_finished], dim=1)
+        best = torch.topk(merged_scores, k=num_beams)[1]
+        sequences = torch.gather(merged_sequences, 1, best[:, :, None].expand(-1, -1, max_length))
+        scores = torch.gather(merged_scores, 1, best)
+        lengths = torch.gather(merged_lengths, 1, best)
+        is_finished = torch.gather(merged_is_finished, 1, best)
+
+        decoder.reorder(beam_idx.flatten())
+        cur_len += 1
+
+        best_running_score = running_scores[:, :1] / ((cur_len - 1) ** length_penalty)
+        worst_finished_score = torch.where(is_finished, scores.min(dim=1, keepdim=True)[0], -1e9)
+        can_improve &= (best_running_score > worst_finished_score).any(dim=-1, keepdim=True)
+
+        all_finished = bool(is_finished.all()) and early_stopping is True
+        if not can_improve.any() or all_finished or bool(hits_stop.all()):
+            break
+
+    length = int(lengths[:, 0].max())
+    return sequences[:, 0, :length]
+
+
+def _ban_repeated_ngrams(scores, sequences, ngram_size):
+    """
+    Set scores of tokens, which would repeat an already generated ngram, to -inf, in place.
+    """
+    cur_len = sequences.shape[1]
+    if ngram_size <= 0 or cur_len + 1 < ngram_size:
+        return
+
+    for i, tokens in enumerate(sequences.tolist()):
+        prefix = tuple(tokens[cur_len + 1 - ngram_size :])
+        banned = [
+            tokens[j + ngram_size - 1]
+            for j in range(cur_len - ngram_size + 1)
+            if tuple(tokens[j : j + ngram_size - 1]) == prefix
+        ]
+        if banned:
+            scores[i, banned] = -float("inf")
@@ -0,0 +1,143 @@
+import numpy as np
+
+# to re-tune the defaults on Manga109-s text boxes exported by process_manga109s.py, see manga_ocr_dev/data/tune_detector.py
+DETECTOR_PARAMS = {
+    "cells_per_page": 200,
+    "ink_threshold": 128,
+    "min_ink": 0.03,
+    "glyph_size": 0.03,
+    "min_line_cells": 3,
+    "max_line_size": 0.15,
+    "min_fill": 0.35,
+    "group_radius": 1,
+    "min_region_cells": 8,
+    "min_blank": 0.15,
+    "max_glyph_ink": 0.5,
+    "min_white_border": 0.6,
+}
+
+
+def detect_text_regions(gray, **params):
+    """
+    Find boxes of text written with dark ink on light background, such as speech balloons, on a grayscale page.
+
+    The page is divided into square cells, about cells_per_page along its height, and connected groups of cells with
+    at least min_ink fraction of ink pixels are classified. Glyphs are smaller than glyph_size (as a fraction of page
+    height), and columns or rows of touching glyphs are between min_line_cells and max_line_size across and fill at
+    least min_fill of their bounding box. This rejects thin lines, like balloon outlines and panel borders, and large
+    connected artwork and screentones. Glyphs closer than group_radius cells are grouped into regions. Regions with
+    less than min_blank of blank cells, or less than min_white_border of blank cells around them, are artwork, and ones
+    with more than max_glyph_ink of ink in glyph cells on average are light text on dark background, or artwork.
+
+    :param gray: (height, width) uint8 array.
+    :param params: Overrides of DETECTOR_PARAMS.
+    :return: List of (xmin, ymin, xmax, ymax) boxes in pixels, in reading order.
+    """
+    params = {**DETECTOR_PARAMS, **params}
+    height, width = gray.shape
+    cell = max(2, height // params["cells_per_page"])
+    rows, cols = height // cell, width // cell
+    if rows < 3 or cols < 3:
+        return []
+
+    ink = gray[: rows * cell, : cols * cell] < params["ink_threshold"]
+    ink = ink.reshape(rows, cell, cols, cell).mean(axis=(1, 3))
+    blank = ink < params["min_ink"] / 4
+
+    glyphs = np.zeros((rows, cols), dtype=bool)
+    glyph_cells = params["glyph_size"] * rows
+    max_line_cells = params["max_line_size"] * rows
+    for ys, xs in _connected_components(ink >= params["min_ink"]):
+        ymin, xmin, ymax, xmax = int(ys.min()), int(xs.min()), int(ys.max()) + 1, int(xs.max()) + 1
+        height_cells, width_cells = ymax - ymin, xmax - xmin
+        fill = len(ys) / (height_cells * width_cells)
+        if max(height_cells, width_cells) <= glyph_cells or (
+            params["min_line_cells"] <= min(height_cells, width_cells) <= max_line_cells and fill >= params["min_fill"]
+        ):
+            glyphs[ys, xs] = True
+
+    # grouping leaves group_radius cells of margin around the text, as in training crops
+    boxes = []
+    for ys, xs in _connected_components(_box_mean(glyphs, params["group_radius"]) > 0):
+        ymin, xmin, ymax, xmax = int(ys.min()), int(xs.min()), int(ys.max()) + 1, int(xs.max()) + 1
+        border = np.concatenate(
+            [
+                blank[max(0, ymin - 1), xmin:xmax],
+                blank[min(rows - 1, ymax), xmin:xmax],
+                blank[ymin:ymax, max(0, xmin - 1)],
+                blank[ymin:ymax, min(cols - 1, xmax)],
+            ]
+        )
+        region_glyphs = glyphs[ymin:ymax, xmin:xmax]
+        if (
+            region_glyphs.sum() >= params["min_region_cells"]
+            and blank[ymin:ymax, xmin:xmax].mean() >= params["min_blank"]
+            and ink[ymin:ymax, xmin:xmax][region_glyphs].mean() <= params["max_glyph_ink"]
+            and border.mean() >= params["min_white_border"]
+        ):
+            boxes.append((xmin * cell, ymin * cell, min(width, xmax * cell), min(height, ymax * cell)))
+
+    return sort_reading_order(_merge_overlapping(boxes))
+
+
+def sort_reading_order(boxes):
+    """
+    Sort boxes in manga reading order: rows from top to bottom, and right to left within a row.
+    A box belongs to the current row if its top is above the middle of the row's first box.
+    """
+    rows = []
+    for box in sorted(boxes, key=lambda box: box[1]):
+        if rows and box[1] < (rows[-1][0][1] + rows[-1][0][3]) / 2:
+            rows[-1].append(box)
+        else:
+            rows.append([box])
+    return [box for row in rows for box in sorted(row, key=lambda box: -box[2])]
+
+
+def _merge_overlapping(boxes):
+    merged = []
+    for box in boxes:
+        while True:
+            overlapping = [m for m in merged if box[0] < m[2] and m[0] < box[2] and box[1] < m[3] and m[1] < box[3]]
+            if not overlapping:
+                break
+            for m in overlapping:
+                merged.remove(m)
+                box = (min(box[0], m[0]), min(box[1], m[1]), max(box[2], m[2]), max(box[3], m[3]))
+        merged.append(box)
+    return merged
+
+
+def _box_mean(x, radius):
+    """
+    Fraction of True elements of a boolean mask in (2 * radius + 1) squares around each element, with zero padding.
+    """
+    size = 2 * radius + 1
+    integral = np.pad(x.astype(np.int32), radius).cumsum(axis=0).cumsum(axis=1)
+    integral = np.pad(integral, ((1, 0), (1, 0)))
+    sums = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+    return sums / size**2
+
+
+def _connected_components(mask):
+    """
+    Yield coordinates (ys, xs) of cells of each 8-connected component of a boolean mask.
+    """
+    visited = np.zeros(mask.shape, dtype=bool)
+    rows, cols = mask.shape
+    for y, x in zip(*np.nonzero(mask)):
+        if visited[y, x]:
+            continue
+        visited[y, x] = True
+        cells = [(y, x)]
+        i = 0
+        while i < len(cells):
+            cy, cx = cells[i]
+            i += 1
+            for ny in range(max(0, cy - 1), min(rows, cy + 2)):
+                for nx in range(max(0, cx - 1), min(cols, cx + 2)):
+                    if mask[ny, nx] and not visited[ny, nx]:
+                        visited[ny, nx] = True
+                        cells.append((ny, nx))
+        ys, xs = np.array(cells).T
+        yield ys, xs
@@ -0,0 +1,165 @@
+import json
+import threading
+import time
+
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Histogram:
+    """
+    Histogram in Prometheus text format, with a separate series for each combination of label values.
+    """
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # labels -> [counts of values in each bucket, count, sum]
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0, 0.0]
+
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += 1
+        series[2] += value
+
+    @property
+    def count(self):
+        return sum(series[1] for series in self.series.values())
+
+    @property
+    def sum(self):
+        return sum(series[2] for series in self.series.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, count, total) in self.series.items():
+            labels = "".join(f'{name}="{value}",' for name, value in key)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{labels}le="+Inf"}} {count}')
+            labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def to_dict(self):
+        return {
+            ",".join(f"{name}={value}" for name, value in key): {
+                "count": count,
+                "sum": total,
+                "mean": total / count,
+                "buckets": dict(zip(self.buckets, counts)),
+            }
+            for key, (counts, count, total) in self.series.items()
+        }
+
+
+class _Timer:
+    def __init__(self, metrics, stage, synchronize):
+        self.metrics = metrics
+        self.stage = stage
+        self.synchronize = synchronize
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.synchronize is not None:
+            self.synchronize()
+        self.metrics.observe_stage(self.stage, time.perf_counter() - self.t0)
+
+
+class OcrMetrics:
+    """
+    Timings of MangaOcr processing stages, and counts of images, batches and tokens, enabled with
+    MangaOcr(metrics=OcrMetrics()). Can be exported as JSON or in Prometheus text format.
+
+    Observations can be recorded from multiple threads.
+
+    Stages are: load (opening and decoding image files), grayscale, resize, transfer (of inputs and outputs between
+    CPU and the model's device), normalize, encoder, decoder_step (each step of decoding, i.e. each token without beam
+    search), decode (all steps together), tokenizer_decode and post_process.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: Optional function called with (name, value) of every observation, where name is
+            a stage name for timings in seconds, or a name of a counter.
+        """
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.stages = Histogram("manga_ocr_stage_duration_seconds", "Time of processing stages.", STAGE_BUCKETS)
+        self.batch_sizes = Histogram("manga_ocr_batch_size", "Number of images recognized at once.", COUNT_BUCKETS)
+        self.tokens = Histogram("manga_ocr_generated_tokens", "Number of tokens generated per image.", COUNT_BUCKETS)
+        self.counters = {
+            "images": 0,
+            "batches": 0,
+            "generated_tokens": 0,
+            "drafts": 0,
+            "accepted_drafts": 0,
+            "draft_tokens": 0,
+            "accepted_draft_tokens": 0,
+        }
+
+    def time(self, stage, synchronize=None):
+        """
+        Context manager recording time of a stage.
+
+        :param synchronize: Optional function waiting for asynchronous operations, e.g. torch.cuda.synchronize,
+            called before the time is taken.
+        """
+        return _Timer(self, stage, synchronize)
+
+    def observe_stage(self, stage, secs):
+        with self._lock:
+            self.stages.observe(secs, stage=stage)
+        if self.callback is not None:
+            self.callback(stage, secs)
+
+    def observe_batch(self, num_tokens):
+        """
+        Record a batch of recognized images, with numbers of tokens generated for each of them.
+        """
+        with self._lock:
+            self.batch_sizes.observe(len(num_tokens))
+            for n in num_tokens:
+                self.tokens.observe(n)
+        self.count("batches")
+        self.count("images", len(num_tokens))
+        self.count("generated_tokens", sum(num_tokens))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+        if self.callback is not None:
+            self.callback(name, value)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "stages": {key.split("=", 1)[1]: value for key, value in self.stages.to_dict().items()},
+                "batch_sizes": self.batch_sizes.to_dict().get("", {}),
+                "generated_tokens": self.tokens.to_dict().get("", {}),
+                "counters": dict(self.counters),
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            for name, value in self.counters.items():
+                lines += [f"# TYPE manga_ocr_{name}_total counter", f"manga_ocr_{name}_total {value}"]
+            for histogram in [self.stages, self.batch_sizes, self.tokens]:
+                lines += histogram.render()
+        return "\n".join(lines) + "\n"
@@ -1,60 +1,561 @@
+import asyncio
+import queue
 import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from contextlib import nullcontext
 from pathlib import Path
 
 import jaconv
+import numpy as np
 import torch
 from PIL import Image
 from loguru import logger
 from transformers import ViTImageProcessor, AutoTokenizer, VisionEncoderDecoderModel, GenerationMixin
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.modeling_outputs import BaseModelOutput
+
+from manga_ocr.async_batching import AsyncBatcher
+from manga_ocr.cache import model_fingerprint
+from manga_ocr.decoding import BertDecoderStep, greedy_decode
+from manga_ocr.detection import detect_text_regions
+from manga_ocr.onnx_backend import OnnxMangaOcrModel
+from manga_ocr.preprocessing import GrayscalePreprocessor
+from manga_ocr.quantization import load_quantized_model
+from manga_ocr.scheduler import argsort_by_length
+from manga_ocr.shared_weights import load_mmap_model
+from manga_ocr.threads import set_cpu_affinity, set_torch_threads
+
+
+# passed explicitly to generate(), so that settings saved in a checkpoint, e.g. beam search used for evaluation
+# during training, don't change how it's decoded
+DECODING_SETTINGS = {
+    "greedy": {"num_beams": 1, "no_repeat_ngram_size": 0},
+    "beam": {"num_beams": 4, "no_repeat_ngram_size": 3, "length_penalty": 2.0, "early_stopping": True},
+}
+
+
+# with greedy decoding, batch() sends this many batches of images at once to the inference thread, within which
+# greedy_decode replaces finished texts with waiting images; more would delay other callers of the instance longer
+CONTINUOUS_BATCHES = 4
+
+_NOT_TIMED = nullcontext()
 
 
 class MangaOcrModel(VisionEncoderDecoderModel, GenerationMixin):
     pass
 
+
+class _StepTimer(StoppingCriteria):
+    """
+    Records time of each decoding step, called either by greedy_decode, or by generate() as a stopping criterion,
+    which never stops.
+    """
+
+    def __init__(self, metrics, synchronize):
+        self.metrics = metrics
+        self.synchronize = synchronize
+        self.t0 = time.perf_counter()
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        if self.synchronize is not None:
+            self.synchronize()
+        t1 = time.perf_counter()
+        self.metrics.observe_stage("decoder_step", t1 - self.t0)
+        self.t0 = t1
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class _TokenStreamer(StoppingCriteria):
+    """
+    Passes token ids of the first sequence decoded so far to a callback after each decoding step, called the same
+    way as _StepTimer.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        self.callback(input_ids[0].tolist())
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+def _init_inference_thread(cpu_affinity):
+    if cpu_affinity is not None:
+        set_cpu_affinity(cpu_affinity)
+
+
+def _log_warmup_error(future):
+    if future.exception() is not None:
+        logger.opt(exception=future.exception()).error("Warmup failed")
+
+
 class MangaOcr:
-    def __init__(self, pretrained_model_name_or_path="kha-white/manga-ocr-base", force_cpu=False):
+    """
+    OCR model with its preprocessing and post-processing. An instance can be used from multiple threads:
+    images are loaded in the calling threads, and recognized one batch at a time by a single inference thread
+    of the instance, fed by a queue.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path="kha-white/manga-ocr-base",
+        force_cpu=False,
+        cache=None,
+        backend="torch",
+        quantize=None,
+        warmup=True,
+        local_files_only=False,
+        mmap_weights=False,
+        decoding="beam",
+        metrics=None,
+        num_threads=None,
+        interop_threads=None,
+        cpu_affinity=None,
+    ):
+        """
+        :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+        :param force_cpu: If True, OCR will use CPU even if GPU is available.
+        :param cache: Optional OcrCache for results of previously seen images.
+        :param backend: Either "torch" or "onnx". ONNX backend requires a model exported with manga_ocr.onnx_backend.
+        :param quantize: If "int8", Linear layers are dynamically quantized and the model runs on CPU.
+        :param warmup: If True, run OCR on an example image, so that the first call isn't slowed down by lazy
+            initialization. If "background", do it in a background thread, which the first call waits for.
+        :param local_files_only: If True, load the model from local files only, without requests to the model hub.
+        :param mmap_weights: If True, weights are memory-mapped from a file in ~/.cache/manga_ocr/mmap and the model
+            runs on CPU. Processes loading the same model this way share a single copy of the weights in memory.
+        :param decoding: Either "beam", for beam search with 4 beams, or "greedy", which is several times faster,
+            and with torch backend runs a dedicated decoding loop instead of generate().
+        :param metrics: Optional OcrMetrics, which records timings of processing stages and counts of tokens.
+            Without it, timings aren't measured at all.
+        :param num_threads: Number of torch's intra-op threads. Note that it's a setting of the whole process,
+            shared by all instances in it.
+        :param interop_threads: Number of torch's inter-op threads, a setting of the whole process, which can be
+            changed only before anything ran in parallel.
+        :param cpu_affinity: Optional CPUs to pin the inference thread to, along with torch threads it starts,
+            e.g. range(8). Supported only on Linux.
+        """
+        if decoding not in DECODING_SETTINGS:
+            raise ValueError(f'decoding must be either "beam" or "greedy", instead got: {decoding}')
+        self.decoding = decoding
+        set_torch_threads(num_threads, interop_threads)
+
         logger.info(f"Loading OCR model from {pretrained_model_name_or_path}")
-        self.processor = ViTImageProcessor.from_pretrained(pretrained_model_name_or_path)
+        self.processor = ViTImageProcessor.from_pretrained(
+            pretrained_model_name_or_path, local_files_only=local_files_only
+        )
+        self._preprocessor = GrayscalePreprocessor(self.processor)
         # explicit tokenizer_type works around transformers>=5.13 misdetecting the tokenizer class
         # for VisionEncoderDecoderModel configs and falling back to an incompatible fast-only backend
-        self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path, tokenizer_type="bert-japanese")
-        self.model = MangaOcrModel.from_pretrained(pretrained_model_name_or_path)
-
-        if not force_cpu and torch.cuda.is_available():
-            logger.info("Using CUDA")
-            self.model.cuda()
-        elif not force_cpu and torch.backends.mps.is_available():
-            logger.info("Using MPS")
-            self.model.to("mps")
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            pretrained_model_name_or_path, tokenizer_type="bert-japanese", local_files_only=local_files_only
+        )
+
+        if backend == "torch" and quantize is not None and mmap_weights:
+            raise ValueError("quantize and mmap_weights can't be used together")
+        elif backend == "torch" and quantize is not None:
+            # dynamically quantized layers run only on CPU
+            logger.info(f"Using CPU with {quantize} quantization")
+            self.model = load_quantized_model(
+                MangaOcrModel, pretrained_model_name_or_path, quantize, local_files_only=local_files_only
+            )
+        elif backend == "torch" and mmap_weights:
+            logger.info("Using CPU with memory-mapped weights")
+            self.model = load_mmap_model(
+                MangaOcrModel, pretrained_model_name_or_path, local_files_only=local_files_only
+            )
+        elif backend == "torch":
+            self.model = MangaOcrModel.from_pretrained(pretrained_model_name_or_path, local_files_only=local_files_only)
+
+            if not force_cpu and torch.cuda.is_available():
+                logger.info("Using CUDA")
+                self.model.cuda()
+            elif not force_cpu and torch.backends.mps.is_available():
+                logger.info("Using MPS")
+                self.model.to("mps")
+            else:
+                logger.info("Using CPU")
+        elif backend == "onnx":
+            if quantize is not None or mmap_weights:
+                raise ValueError("quantize and mmap_weights are supported only with torch backend")
+            logger.info("Using ONNX Runtime")
+            self.model = OnnxMangaOcrModel(pretrained_model_name_or_path)
+        else:
+            raise ValueError(f'backend must be either "torch" or "onnx", instead got: {backend}')
+
+        self._decoder_step = BertDecoderStep(self.model).eval() if isinstance(self.model, MangaOcrModel) else None
+
+        # measured times of stages include waiting for asynchronous GPU operations
+        self._synchronize = None
+        if self.model.device.type == "cuda":
+            self._synchronize = torch.cuda.synchronize
+        elif self.model.device.type == "mps":
+            self._synchronize = torch.mps.synchronize
+        # attached only after the warmup, so that the example image isn't counted
+        self.metrics = None
+
+        self.cache = cache
+        self._model_id = (pretrained_model_name_or_path, backend, quantize)
+        # counts of drafts and their tokens, which turned out to be right
+        self.draft_stats = {"drafts": 0, "accepted_drafts": 0, "draft_tokens": 0, "accepted_tokens": 0}
+        # AsyncBatcher of the event loop, in which aocr was last awaited
+        self._async_batcher = None
+        self._executor = ThreadPoolExecutor(
+            1, thread_name_prefix="manga_ocr", initializer=_init_inference_thread, initargs=(cpu_affinity,)
+        )
+
+        if warmup == "background":
+            # recognition queued later waits for the warmup to finish
+            self._executor.submit(self._warmup).add_done_callback(_log_warmup_error)
+            self._executor.submit(setattr, self, "metrics", metrics)
+            logger.info("OCR ready, warming up in background")
         else:
-            logger.info("Using CPU")
+            if warmup:
+                self._run(self._warmup)
+            self.metrics = metrics
+            logger.info("OCR ready")
 
+    def _warmup(self):
         example_path = Path(__file__).parent / "assets/example.jpg"
         if not example_path.is_file():
             raise FileNotFoundError(f"Missing example image {example_path}")
-        self(example_path)
+        self._generate([self._read_image(example_path)], {"max_length": 300, **DECODING_SETTINGS[self.decoding]})
+
+    def __call__(self, img_or_path, draft=None, **generate_kwargs):
+        """
+        Recognize a single image.
+
+        :param img_or_path: Image or a path to it.
+        :param draft: Optional text expected in the image, e.g. the result for a slightly different crop of the same
+            text. With greedy decoding, it's checked in a single decoder pass and decoding continues only from the
+            first character which doesn't match, so a correct draft is much faster. Results don't depend on it.
+        """
+        img = self._read_image(img_or_path)
+        return self._run(self._recognize, [img], generate_kwargs, None if draft is None else [draft])[0]
+
+    def batch(self, imgs_or_paths, batch_size=16, sort_by_length=False, drafts=None, **generate_kwargs):
+        """
+        Recognize multiple images, decoding up to batch_size of them at once.
+        Returns a list of texts, in the same order as the input.
+
+        Beam search runs one generate() call per chunk of batch_size images. With greedy decoding and torch backend,
+        each finished text is replaced in the batch by the next waiting image instead (continuous batching),
+        so that short texts don't wait for the longest text in their batch to finish decoding.
+
+        If sort_by_length is True, all images are loaded upfront and grouped into batches by estimated text length,
+        which also reduces waiting for the longest text in a batch.
+
+        Optional drafts are expected texts of the images, or None for unknown ones, see __call__.
+        """
+        imgs_or_paths = list(imgs_or_paths)
+        order = list(range(len(imgs_or_paths)))
+
+        if sort_by_length:
+            imgs_or_paths = [self._open_image(img_or_path) for img_or_path in imgs_or_paths]
+            order = argsort_by_length(imgs_or_paths)
+
+        return self._recognize_in_order(
+            order, lambda i: self._read_image(imgs_or_paths[i]), batch_size, generate_kwargs, drafts
+        )
+
+    def read_page(self, img_or_path, batch_size=16, detector_params=None, **generate_kwargs):
+        """
+        Find text regions on a whole manga page and recognize them.
+        Regions are cut from the page as numpy views, without copying, and recognized in batches of similar size.
+
+        :param img_or_path: Page image or a path to it.
+        :param batch_size: Maximum number of regions recognized at once.
+        :param detector_params: Optional overrides of manga_ocr.detection.DETECTOR_PARAMS.
+        :return: List of {"box": (xmin, ymin, xmax, ymax), "text": ...} in reading order.
+        """
+        page = np.asarray(self._read_image(img_or_path))
+        boxes = detect_text_regions(page, **(detector_params or {}))
+        crops = [page[ymin:ymax, xmin:xmax] for xmin, ymin, xmax, ymax in boxes]
+
+        # box area is a rough estimate of text length, see batch(sort_by_length=True)
+        order = sorted(range(len(crops)), key=lambda i: crops[i].size)
+        texts = self._recognize_in_order(order, crops.__getitem__, batch_size, generate_kwargs)
+
+        return [{"box": box, "text": text} for box, text in zip(boxes, texts)]
 
-        logger.info("OCR ready")
+    def stream(self, img_or_path, **generate_kwargs):
+        """
+        Recognize a single image, yielding the text recognized so far, each time it grows during decoding.
+        Partial texts are post-processed the same way as the final one, of which they are always prefixes,
+        and the last yielded text is the same as the result of __call__.
 
-    def __call__(self, img_or_path):
+        Partial texts are available only with greedy decoding and torch backend. Beam search finds the best text
+        only at the end, so otherwise only the final text is yielded.
+        """
+        img = self._read_image(img_or_path)
+        token_ids = queue.Queue()
+        future = self._executor.submit(self._recognize, [img], generate_kwargs, None, token_ids.put)
+        future.add_done_callback(lambda _: token_ids.put(None))
+
+        text = ""
+        while (ids := token_ids.get()) is not None:
+            partial_text = post_process_partial(self.tokenizer.decode(ids, skip_special_tokens=True))
+            if partial_text != text:
+                text = partial_text
+                yield text
+
+        final_text = future.result()[0]
+        if final_text != text:
+            yield final_text
+
+    async def aocr(self, img_or_path):
+        """
+        Recognize a single image without blocking the event loop. The image is loaded in the loop's default
+        executor, and recognized in the inference thread, together with other images awaited concurrently
+        in the same loop. Results are the same as with __call__.
+
+        If the awaiting task is cancelled before its batch starts, the image is skipped.
+        """
+        loop = asyncio.get_running_loop()
+        img = await loop.run_in_executor(None, self._read_image, img_or_path)
+        if self._async_batcher is None or self._async_batcher.loop is not loop:
+            self._async_batcher = AsyncBatcher(self, loop)
+        return await self._async_batcher.submit(img)
+
+    async def aocr_iter(self, imgs_or_paths, max_pending=32):
+        """
+        Recognize a sequence of images, given as an iterable or an async iterable, yielding texts in the same order.
+        Up to max_pending images are recognized concurrently, sharing batches. Images still pending when
+        the generator is closed early are cancelled.
+        """
+        if not hasattr(imgs_or_paths, "__aiter__"):
+            imgs_or_paths = _to_async_iterable(imgs_or_paths)
+
+        pending = deque()
+        try:
+            async for img_or_path in imgs_or_paths:
+                pending.append(asyncio.ensure_future(self.aocr(img_or_path)))
+                if len(pending) >= max_pending:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _run(self, fn, *args):
+        """
+        Run a function in the inference thread and wait for its result. Calls from other threads wait in a queue,
+        so that the model, cache and stats are used by one thread at a time.
+        """
+        return self._executor.submit(fn, *args).result()
+
+    def _recognize_in_order(self, order, load, batch_size, generate_kwargs, drafts=None):
+        """
+        Recognize images load(i) in the given order of indices i, in batches of batch_size, and return their texts
+        ordered by i. With greedy decoding, several batches are recognized in one call, see CONTINUOUS_BATCHES.
+        """
+        chunk_size = batch_size
+        if self._is_greedy(self._generate_kwargs(generate_kwargs)):
+            chunk_size *= CONTINUOUS_BATCHES
+
+        texts = [None] * len(order)
+        for i in range(0, len(order), chunk_size):
+            indices = order[i : i + chunk_size]
+            imgs = [load(j) for j in indices]
+            chunk_drafts = None if drafts is None else [drafts[j] for j in indices]
+            chunk_texts = self._run(self._recognize, imgs, generate_kwargs, chunk_drafts, None, batch_size)
+            for j, text in zip(indices, chunk_texts):
+                texts[j] = text
+
+        return texts
+
+    def _generate_kwargs(self, generate_kwargs):
+        return {"max_length": 300, **DECODING_SETTINGS[self.decoding], **generate_kwargs}
+
+    def _recognize(self, imgs, generate_kwargs, drafts=None, stream_callback=None, batch_size=None):
+        """
+        Recognize imgs in the inference thread. With greedy decoding, at most batch_size of them are decoded at once,
+        otherwise they should be a single batch.
+        """
+        generate_kwargs = self._generate_kwargs(generate_kwargs)
+
+        if drafts is not None and not self._is_greedy(generate_kwargs):
+            raise ValueError('drafts can be used only with decoding="greedy" and torch backend')
+
+        if self.cache is None:
+            return self._generate(imgs, generate_kwargs, None, drafts, stream_callback, batch_size)
+
+        # results of the same image differ between models, or versions and variants of a model
+        keys = [f"{self._model_fingerprint}:{self.cache.image_key(img)}" for img in imgs]
+        # texts depend on generation settings, encoder outputs only on the image
+        settings = repr(sorted(generate_kwargs.items()))
+        texts = [self.cache.get_text(f"{key}:{settings}") for key in keys]
+
+        missing = [i for i, text in enumerate(texts) if text is None]
+        if missing:
+            new_texts = self._generate(
+                [imgs[i] for i in missing],
+                generate_kwargs,
+                [keys[i] for i in missing],
+                None if drafts is None else [drafts[i] for i in missing],
+                stream_callback,
+                batch_size,
+            )
+            for i, text in zip(missing, new_texts):
+                self.cache.put_text(f"{keys[i]}:{settings}", text)
+                texts[i] = text
+
+        return texts
+
+    def _generate(self, imgs, generate_kwargs, keys=None, drafts=None, stream_callback=None, batch_size=None):
+        if keys is not None and self.cache.keep_encoder_outputs:
+            hidden_states = [self.cache.get_encoder_outputs(key) for key in keys]
+            missing = [i for i, h in enumerate(hidden_states) if h is None]
+            if missing:
+                new_hidden_states = self._encode([imgs[i] for i in missing], batch_size)
+                for i, h in zip(missing, new_hidden_states):
+                    self.cache.put_encoder_outputs(keys[i], h)
+                    hidden_states[i] = h
+            hidden_states = torch.stack(hidden_states)
+        else:
+            hidden_states = self._encode(imgs, batch_size)
+
+        config = self.model.generation_config
+        # called after each decoding step, with tokens decoded so far
+        step_callbacks = [] if self.metrics is None else [_StepTimer(self.metrics, self._synchronize)]
+        if stream_callback is not None and generate_kwargs["num_beams"] == 1:
+            step_callbacks.append(_TokenStreamer(stream_callback))
+
+        def step_callback(sequences):
+            for callback in step_callbacks:
+                callback(sequences)
+
+        with self._timed("decode"):
+            if self._is_greedy(generate_kwargs):
+                draft_ids = None
+                if drafts is not None:
+                    # the model generates texts tokenized with special tokens, following the decoder start token
+                    draft_ids = [[] if draft is None else self.tokenizer.encode(draft)[:-1] for draft in drafts]
+                x = greedy_decode(
+                    self._decoder_step,
+                    hidden_states,
+                    config.decoder_start_token_id,
+                    config.eos_token_id,
+                    config.pad_token_id,
+                    generate_kwargs["max_length"],
+                    draft_ids,
+                    step_callback if step_callbacks else None,
+                    batch_size,
+                )
+            else:
+                if step_callbacks and self._decoder_step is not None:
+                    generate_kwargs = {**generate_kwargs, "stopping_criteria": StoppingCriteriaList(step_callbacks)}
+                encoder_outputs = BaseModelOutput(last_hidden_state=hidden_states)
+                x = self.model.generate(encoder_outputs=encoder_outputs, **generate_kwargs)
+
+        with self._timed("transfer"):
+            x = x.cpu()
+
+        if drafts is not None:
+            self._update_draft_stats(drafts, draft_ids, x.tolist(), config.eos_token_id)
+        if self.metrics is not None:
+            self.metrics.observe_batch((x[:, 1:] != config.pad_token_id).sum(dim=1).tolist())
+
+        with self._timed("tokenizer_decode"):
+            x = self.tokenizer.batch_decode(x, skip_special_tokens=True)
+        with self._timed("post_process"):
+            return [post_process(text) for text in x]
+
+    def _update_draft_stats(self, drafts, draft_ids, sequences, eos_token_id):
+        for text, draft, sequence in zip(drafts, draft_ids, sequences):
+            if text is None:
+                continue
+
+            # decoding keeps exactly the longest prefix of a draft, which matches the result
+            tokens = sequence[1:]
+            num_accepted = 0
+            while num_accepted < min(len(draft), len(tokens)) and draft[num_accepted] == tokens[num_accepted]:
+                num_accepted += 1
+            is_accepted = num_accepted == len(draft) and tokens[len(draft) : len(draft) + 1] == [eos_token_id]
+
+            self.draft_stats["drafts"] += 1
+            self.draft_stats["accepted_drafts"] += int(is_accepted)
+            self.draft_stats["draft_tokens"] += len(draft)
+            self.draft_stats["accepted_tokens"] += num_accepted
+            if self.metrics is not None:
+                self.metrics.count("drafts")
+                self.metrics.count("accepted_drafts", int(is_accepted))
+                self.metrics.count("draft_tokens", len(draft))
+                self.metrics.count("accepted_draft_tokens", num_accepted)
+
+        stats = self.draft_stats
+        logger.debug(
+            f"Drafts accepted: {stats['accepted_drafts']}/{stats['drafts']}, "
+            f"draft tokens accepted: {stats['accepted_tokens']}/{stats['draft_tokens']}"
+        )
+
+    @cached_property
+    def _model_fingerprint(self):
+        return model_fingerprint(*self._model_id)
+
+    def _encode(self, imgs, batch_size=None):
+        if batch_size is not None and len(imgs) > batch_size:
+            return torch.cat([self._encode(imgs[i : i + batch_size]) for i in range(0, len(imgs), batch_size)])
+        x = self._preprocess(imgs)
+        with torch.no_grad(), self._timed("encoder"):
+            return self.model.encoder(x).last_hidden_state
+
+    def _timed(self, stage):
+        """
+        Context manager recording time of a stage, if metrics are enabled.
+        """
+        if self.metrics is None:
+            return _NOT_TIMED
+        return self.metrics.time(stage, self._synchronize)
+
+    def _is_greedy(self, generate_kwargs):
+        """
+        Whether generate_kwargs ask for plain greedy decoding, which greedy_decode can do instead of generate().
+        """
+        return (
+            self._decoder_step is not None
+            and generate_kwargs.keys() <= {"max_length", *DECODING_SETTINGS["greedy"]}
+            and all(generate_kwargs[name] == value for name, value in DECODING_SETTINGS["greedy"].items())
+        )
+
+    def _read_image(self, img_or_path):
+        with self._timed("load"):
+            img = self._open_image(img_or_path)
+            img.load()
+        with self._timed("grayscale"):
+            return img.convert("L")
+
+    @staticmethod
+    def _open_image(img_or_path):
         if isinstance(img_or_path, str) or isinstance(img_or_path, Path):
             img = Image.open(img_or_path)
         elif isinstance(img_or_path, Image.Image):
             img = img_or_path
+        elif isinstance(img_or_path, np.ndarray):
+            img = Image.fromarray(img_or_path)
         else:
-            raise ValueError(f"img_or_path must be a path or PIL.Image, instead got: {img_or_path}")
+            raise ValueError(f"img_or_path must be a path, PIL.Image or numpy array, instead got: {img_or_path}")
 
-        img = img.convert("L").convert("RGB")
+        return img
 
-        x = self._preprocess(img)
-        x = self.model.generate(x[None].to(self.model.device), max_length=300)[0].cpu()
-        x = self.tokenizer.decode(x, skip_special_tokens=True)
-        x = post_process(x)
-        return x
+    def _preprocess(self, imgs):
+        """
+        Pixel values of grayscale images, on the model's device.
+        """
+        with self._timed("resize"):
+            pixels = self._preprocessor.resize(imgs)
+        with self._timed("transfer"):
+            pixels = torch.from_numpy(pixels).to(self.model.device)
+        with self._timed("normalize"):
+            return self._preprocessor.normalize(pixels)
 
-    def _preprocess(self, img):
-        pixel_values = self.processor(img, return_tensors="pt").pixel_values
-        return pixel_values.squeeze()
+
+async def _to_async_iterable(iterable):
+    for item in iterable:
+        yield item
 
 
 def post_process(text):
@@ -64,3 +565,13 @@ def post_process(text):
     text = jaconv.h2z(text, ascii=True, digit=True)
 
     return text
+
+
+def post_process_partial(text):
+    """
+    post_process for a text which is still being decoded, so that the result is always a prefix of the final one.
+    Trailing characters which could still change along with the following ones are left out: dots, which might turn
+    out to be a part of an ellipsis, and half-width katakana, which might be followed by a voiced sound mark.
+    """
+    text = "".join(text.split())
+    return post_process(re.sub("[・.…\uff66-\uff9d]+$", "", text))
@@ -0,0 +1,204 @@
+from pathlib import Path
+
+import fire
+import numpy as np
+import torch
+from loguru import logger
+from torch import nn
+from transformers import AutoTokenizer, GenerationConfig, VisionEncoderDecoderModel, ViTImageProcessor
+from transformers.modeling_outputs import BaseModelOutput
+
+from manga_ocr.decoding import BertDecoderStep, generate
+
+GENERATION_SETTINGS = (
+    "decoder_start_token_id",
+    "eos_token_id",
+    "pad_token_id",
+    "max_length",
+    "num_beams",
+    "no_repeat_ngram_size",
+    "length_penalty",
+    "early_stopping",
+)
+
+
+class _Encoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.encoder
+
+    def forward(self, pixel_values):
+        return self.encoder(pixel_values=pixel_values).last_hidden_state
+
+
+class _CrossAttention(nn.Module):
+    def __init__(self, step):
+        super().__init__()
+        self.step = step
+
+    def forward(self, encoder_hidden_states):
+        return tuple(self.step.cross_attention_kv(encoder_hidden_states))
+
+
+class _Decoder(nn.Module):
+    def __init__(self, step):
+        super().__init__()
+        self.step = step
+        self.num_kv = 2 * len(step.layers)
+
+    def forward(self, input_ids, position_ids, *kv):
+        logits, present_kv = self.step(input_ids, position_ids, list(kv[: self.num_kv]), list(kv[self.num_kv :]))
+        return (logits, *present_kv)
+
+
+def export_onnx(output_dir, pretrained_model_name_or_path="kha-white/manga-ocr-base", opset_version=17):
+    """
+    Export a model to ONNX graphs used by MangaOcr(backend="onnx"): encoder, cross-attention keys/values
+    and a single decoding step with past self-attention keys/values.
+
+    :param output_dir: Directory to save the graphs, processor and tokenizer to.
+    :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+    :param opset_version: ONNX opset version.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"Exporting {pretrained_model_name_or_path} to {output_dir}")
+    model = VisionEncoderDecoderModel.from_pretrained(pretrained_model_name_or_path).eval()
+    step = BertDecoderStep(model).eval()
+    num_layers = len(step.layers)
+
+    image_size = model.config.encoder.image_size
+    pixel_values = torch.zeros(2, model.config.encoder.num_channels, image_size, image_size)
+    input_ids = torch.full((2, 1), model.generation_config.decoder_start_token_id, dtype=torch.long)
+    position_ids = torch.zeros((2, 1), dtype=torch.long)
+
+    with torch.no_grad():
+        encoder_hidden_states = model.encoder(pixel_values=pixel_values).last_hidden_state
+        cross_kv = step.cross_attention_kv(encoder_hidden_states)
+        past_kv = [torch.zeros(2, step.num_heads, 3, step.head_size) for _ in range(2 * num_layers)]
+
+    kv_names = [f"{kind}_{i}" for i in range(num_layers) for kind in ("key", "value")]
+    cross_kv_names = [f"cross_{name}" for name in kv_names]
+    past_kv_names = [f"past_{name}" for name in kv_names]
+    present_kv_names = [f"present_{name}" for name in kv_names]
+
+    export_kwargs = {"opset_version": opset_version, "dynamo": False}
+
+    torch.onnx.export(
+        _Encoder(model),
+        (pixel_values,),
+        output_dir / "encoder.onnx",
+        input_names=["pixel_values"],
+        output_names=["encoder_hidden_states"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "encoder_hidden_states": {0: "batch"}},
+        **export_kwargs,
+    )
+
+    torch.onnx.export(
+        _CrossAttention(step),
+        (encoder_hidden_states,),
+        output_dir / "cross_attention.onnx",
+        input_names=["encoder_hidden_states"],
+        output_names=cross_kv_names,
+        dynamic_axes={name: {0: "batch"} for name in ["encoder_hidden_states", *cross_kv_names]},
+        **export_kwargs,
+    )
+
+    torch.onnx.export(
+        _Decoder(step),
+        (input_ids, position_ids, *cross_kv, *past_kv),
+        output_dir / "decoder.onnx",
+        input_names=["input_ids", "position_ids", *cross_kv_names, *past_kv_names],
+        output_names=["logits", *present_kv_names],
+        dynamic_axes={
+            "input_ids": {0: "batch"},
+            "position_ids": {0: "batch"},
+            "logits": {0: "batch"},
+            **{name: {0: "batch"} for name in cross_kv_names},
+            **{name: {0: "batch", 2: "past_length"} for name in past_kv_names},
+            **{name: {0: "batch", 2: "length"} for name in present_kv_names},
+        },
+        **export_kwargs,
+    )
+
+    model.generation_config.save_pretrained(output_dir)
+    ViTImageProcessor.from_pretrained(pretrained_model_name_or_path).save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(pretrained_model_name_or_path, tokenizer_type="bert-japanese").save_pretrained(
+        output_dir
+    )
+
+    logger.info("Export finished")
+
+
+class OnnxMangaOcrModel:
+    """
+    Runs a model exported with export_onnx on ONNX Runtime, decoding in a Python loop.
+    Exposes the subset of VisionEncoderDecoderModel interface used by MangaOcr.
+    """
+
+    def __init__(self, path, providers=None):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(
+                'ONNX backend requires onnxruntime, install it with: pip install "manga-ocr[onnx]"'
+            ) from e
+
+        path = Path(path)
+        for name in ["encoder.onnx", "cross_attention.onnx", "decoder.onnx"]:
+            if not (path / name).is_file():
+                raise FileNotFoundError(
+                    f"Missing {path / name}, export the model first with: python -m manga_ocr.onnx_backend {path}"
+                )
+
+        providers = providers or ["CPUExecutionProvider"]
+        self.encoder_session = onnxruntime.InferenceSession(str(path / "encoder.onnx"), providers=providers)
+        self.cross_attention_session = onnxruntime.InferenceSession(
+            str(path / "cross_attention.onnx"), providers=providers
+        )
+        self.decoder_session = onnxruntime.InferenceSession(str(path / "decoder.onnx"), providers=providers)
+        self.generation_config = GenerationConfig.from_pretrained(path)
+        self.device = torch.device("cpu")
+
+    def encoder(self, pixel_values):
+        (hidden_states,) = self.encoder_session.run(None, {"pixel_values": pixel_values.numpy()})
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(hidden_states))
+
+    def generate(self, pixel_values=None, encoder_outputs=None, **kwargs):
+        if encoder_outputs is None:
+            encoder_outputs = self.encoder(pixel_values)
+        hidden_states = encoder_outputs.last_hidden_state.cpu().numpy()
+
+        settings = {name: getattr(self.generation_config, name) for name in GENERATION_SETTINGS}
+        settings.update(kwargs)
+        settings = {name: value for name, value in settings.items() if value is not None}
+
+        decoder = _OnnxDecoder(self, hidden_states)
+        return generate(decoder, hidden_states.shape[0], **settings)
+
+
+class _OnnxDecoder:
+    def __init__(self, model, encoder_hidden_states):
+        self.session = model.decoder_session
+        self.cross_kv = model.cross_attention_session.run(None, {"encoder_hidden_states": encoder_hidden_states})
+
+        batch_size, num_heads, _, head_size = self.cross_kv[0].shape
+        self.past_kv = [np.zeros((batch_size, num_heads, 0, head_size), dtype=np.float32) for _ in self.cross_kv]
+        self.names = [x.name for x in self.session.get_inputs()]
+
+    def step(self, input_ids, position):
+        input_ids = input_ids.numpy()
+        position_ids = np.full_like(input_ids, position)
+        inputs = dict(zip(self.names, [input_ids, position_ids, *self.cross_kv, *self.past_kv]))
+        logits, *self.past_kv = self.session.run(None, inputs)
+        return torch.from_numpy(logits)
+
+    def reorder(self, indices):
+        indices = indices.numpy()
+        self.cross_kv = [x[indices] for x in self.cross_kv]
+        self.past_kv = [x[indices] for x in self.past_kv]
+
+
+if __name__ == "__main__":
+    fire.Fire(export_onnx)
@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+from pathlib import Path
+
+import pyperclip
+from loguru import logger
+from PIL import UnidentifiedImageError
+
+_STOP = object()
+
+
+def write_results(texts, write_to):
+    if write_to == "clipboard":
+        pyperclip.copy("\n".join(texts))
+    else:
+        with Path(write_to).open("a", encoding="utf-8") as f:
+            f.write("".join(text + "\n" for text in texts))
+
+
+class OcrPipeline:
+    """
+    Runs OCR in three threads connected with bounded queues: image decoding, recognition and writing of results,
+    so that reading and decoding of next images overlaps with recognition of the current ones.
+    Recognition takes all images waiting in the queue at once, up to batch_size, and writing takes all texts waiting
+    for it, so that a burst of images is processed at the throughput of the model.
+    """
+
+    def __init__(self, mocr, write_to, batch_size=16, max_queue_size=64):
+        """
+        :param mocr: MangaOcr instance.
+        :param write_to: Either "clipboard", or a path to a text file.
+        :param batch_size: Maximum number of images recognized at once.
+        :param max_queue_size: Maximum number of images waiting in each queue. When it's reached, put() blocks.
+        """
+        if write_to != "clipboard" and Path(write_to).suffix != ".txt":
+            raise ValueError('write_to must be either "clipboard" or a path to a text file')
+
+        self.mocr = mocr
+        self.write_to = write_to
+        self.batch_size = batch_size
+
+        self.decode_queue = queue.Queue(max_queue_size)
+        self.ocr_queue = queue.Queue(max_queue_size)
+        self.write_queue = queue.Queue()
+
+        self.threads = [
+            threading.Thread(target=self._decode_loop, name="decode", daemon=True),
+            threading.Thread(target=self._ocr_loop, name="ocr", daemon=True),
+            threading.Thread(target=self._write_loop, name="write", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, img_or_path):
+        """
+        Queue an image or a path to an image file for recognition.
+        """
+        self.decode_queue.put(img_or_path)
+
+    def close(self):
+        """
+        Wait until all queued images are processed and stop the threads.
+        """
+        self.decode_queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _decode_loop(self):
+        while (img_or_path := self.decode_queue.get()) is not _STOP:
+            t0 = time.time()
+            # an item which can't be read is skipped, since stopping this thread would leave close() waiting forever
+            try:
+                img = self.mocr._read_image(img_or_path)
+            except (UnidentifiedImageError, OSError) as e:
+                logger.warning(f"Error while reading file {img_or_path}: {e}")
+            except Exception:
+                logger.exception(f"Error while reading {img_or_path!r}")
+            else:
+                self.ocr_queue.put((img, time.time() - t0))
+
+        self.ocr_queue.put(_STOP)
+
+    def _ocr_loop(self):
+        stop = False
+        while not stop:
+            items = [self.ocr_queue.get()]
+            while len(items) < self.batch_size and not self.ocr_queue.empty():
+                items.append(self.ocr_queue.get())
+
+            if items[-1] is _STOP:
+                stop = True
+                items.pop()
+            if not items:
+                continue
+
+            imgs, decode_secs = zip(*items)
+            t0 = time.time()
+            try:
+                texts = self.mocr.batch(imgs, batch_size=self.batch_size)
+            except Exception:
+                logger.exception(f"Error while recognizing {len(imgs)} images")
+                continue
+            t1 = time.time()
+
+            logger.info(
+                f"{len(texts)} texts recognized in {t1 - t0:0.03f} s (decoding {sum(decode_secs):0.03f} s), "
+                f"queued: {self.decode_queue.qsize()} to decode, {self.ocr_queue.qsize()} to recognize"
+            )
+            self.write_queue.put(texts)
+
+        self.write_queue.put(_STOP)
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            batches = [self.write_queue.get()]
+            while not self.write_queue.empty():
+                batches.append(self.write_queue.get())
+
+            if batches[-1] is _STOP:
+                stop = True
+                batches.pop()
+
+            texts = [text for batch in batches for text in batch]
+            if not texts:
+                continue
+
+            t0 = time.time()
+            try:
+                write_results(texts, self.write_to)
+            except Exception:
+                logger.exception(f"Error while writing {len(texts)} texts")
+                continue
+            t1 = time.time()
+
+            for text in texts:
+                logger.info(f"Text: {text}")
+            logger.debug(f"{len(texts)} texts written in {t1 - t0:0.03f} s")
@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+
+from manga_ocr.ocr import MangaOcr, MangaOcrModel
+from manga_ocr.shared_weights import MMAP_MODELS_DIR, get_mmap_model_dir, prepare_mmap_weights
+from manga_ocr.threads import set_cpu_affinity, split_cpus
+
+_mocr = None
+
+
+def _init_worker(num_threads, cpu_sets, worker_counter, pretrained_model_name_or_path, kwargs):
+    global _mocr
+    if cpu_sets is not None:
+        # pin the whole process before torch starts any threads, which inherit the affinity
+        with worker_counter.get_lock():
+            i = worker_counter.value
+            worker_counter.value += 1
+        set_cpu_affinity(cpu_sets[i % len(cpu_sets)])
+    _mocr = MangaOcr(pretrained_model_name_or_path, mmap_weights=True, num_threads=num_threads, **kwargs)
+
+
+def _recognize(img_or_path):
+    return _mocr(img_or_path)
+
+
+class MangaOcrPool:
+    """
+    Pool of worker processes running MangaOcr on CPU, with weights memory-mapped from a single file,
+    so that all workers together use roughly as much memory for the weights as a single one.
+    """
+
+    def __init__(
+        self, num_workers=None, pretrained_model_name_or_path="kha-white/manga-ocr-base", pin_cpus=False, **kwargs
+    ):
+        """
+        :param num_workers: Number of worker processes. Defaults to the number of CPUs.
+        :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+        :param pin_cpus: If True, each worker is pinned to its own set of CPUs, so that workers don't compete
+            for the same cores. Supported only on Linux.
+        :param kwargs: Other arguments passed to MangaOcr in each worker.
+        """
+        self.num_workers = num_workers or os.cpu_count()
+        self.pretrained_model_name_or_path = pretrained_model_name_or_path
+
+        # convert weights once, before the workers start
+        prepare_mmap_weights(
+            MangaOcrModel, pretrained_model_name_or_path, local_files_only=kwargs.get("local_files_only", False)
+        )
+
+        # split CPU threads between workers, instead of each of them trying to use all of them
+        cpu_sets = split_cpus(self.num_workers) if pin_cpus else None
+        num_threads = len(cpu_sets[0]) if pin_cpus else max(1, os.cpu_count() // self.num_workers)
+        num_threads = kwargs.pop("num_threads", num_threads)
+        # spawn instead of fork, so that workers don't inherit torch's thread pools and locks of the parent
+        context = multiprocessing.get_context("spawn")
+        self.pool = context.Pool(
+            self.num_workers,
+            initializer=_init_worker,
+            initargs=(num_threads, cpu_sets, context.Value("i", 0), pretrained_model_name_or_path, kwargs),
+        )
+
+    @property
+    def weights_path(self):
+        return get_mmap_model_dir(self.pretrained_model_name_or_path, MMAP_MODELS_DIR) / "model.safetensors"
+
+    @property
+    def pids(self):
+        return [process.pid for process in self.pool._pool]
+
+    def __call__(self, img_or_path):
+        return self.pool.apply(_recognize, (img_or_path,))
+
+    def map(self, imgs_or_paths, chunksize=1):
+        """
+        Recognize multiple images in parallel. Returns a list of texts, in the same order as the input.
+        """
+        return self.pool.map(_recognize, imgs_or_paths, chunksize=chunksize)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+from PIL import Image
+
+
+class GrayscalePreprocessor:
+    """
+    Equivalent of ViTImageProcessor for grayscale images, with the settings of a given processor.
+
+    Images are resized as single-channel uint8 with PIL, the same way the processor resizes them, and then stacked,
+    rescaled and normalized in a single torch operation per batch, optionally on the model's device, so that only
+    uint8 pixels are transferred. The 3 input channels are broadcast from the grayscale one, instead of converting
+    images to RGB.
+    """
+
+    def __init__(self, processor):
+        """
+        :param processor: ViTImageProcessor, whose settings are used.
+        """
+        self.size = (processor.size["width"], processor.size["height"]) if processor.do_resize else None
+        self.resample = processor.resample
+        scale = processor.rescale_factor if processor.do_rescale else 1.0
+        mean = processor.image_mean if processor.do_normalize else [0.0] * 3
+        std = processor.image_std if processor.do_normalize else [1.0] * 3
+
+        # (x * scale - mean) / std == x * weight + bias, per channel
+        self.weight = torch.tensor([scale / s for s in std]).view(1, 3, 1, 1)
+        self.bias = torch.tensor([-m / s for m, s in zip(mean, std)]).view(1, 3, 1, 1)
+
+    def __call__(self, imgs, device=None):
+        """
+        :param imgs: List of PIL images, or (height, width) uint8 arrays of grayscale images.
+            Images of other modes are converted to grayscale.
+        :param device: Device to rescale and normalize on, CPU by default.
+        :return: (batch, 3, height, width) float32 tensor of pixel values.
+        """
+        return self.normalize(torch.from_numpy(self.resize(imgs)).to(device))
+
+    def resize(self, imgs):
+        """
+        Return resized grayscale images as a (batch, height, width) uint8 array.
+        """
+        pixels = None
+        for i, img in enumerate(imgs):
+            if isinstance(img, np.ndarray):
+                img = Image.fromarray(img)
+            img = img.convert("L")
+            if self.size is not None:
+                img = img.resize(self.size, self.resample)
+
+            if pixels is None:
+                pixels = np.empty((len(imgs), img.height, img.width), dtype=np.uint8)
+            elif pixels.shape[1:] != (img.height, img.width):
+                raise ValueError("Images must have the same size, when the processor doesn't resize them")
+            pixels[i] = np.asarray(img)
+        return pixels
+
+    def normalize(self, pixels):
+        """
+        Return pixel values for a (batch, height, width) uint8 tensor of resized images, on the same device.
+        """
+        x = pixels[:, None]
+        return x * self.weight.to(x.device) + self.bias.to(x.device)
@@ -0,0 +1,84 @@
+import os
+import re
+from pathlib import Path
+
+import torch
+import transformers
+from loguru import logger
+from torch import nn
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+from transformers import GenerationConfig
+
+from manga_ocr.cache import model_revision
+from manga_ocr.shared_weights import init_empty_weights
+
+QUANTIZED_MODELS_DIR = Path("~/.cache/manga_ocr/quantized").expanduser()
+
+
+def get_quantized_model_path(pretrained_model_name_or_path, cache_dir=QUANTIZED_MODELS_DIR):
+    name = re.sub(r"[^\w.-]+", "_", str(pretrained_model_name_or_path)).strip("_")
+    # a new commit of a model from the hub, or an overwritten local model, gets a new file
+    name += f"-{model_revision(pretrained_model_name_or_path)}"
+    return Path(cache_dir) / f"{name}-int8-torch{torch.__version__}-transformers{transformers.__version__}.pt"
+
+
+def load_quantized_model(
+    model_cls, pretrained_model_name_or_path, quantize="int8", cache_dir=QUANTIZED_MODELS_DIR, **kwargs
+):
+    """
+    Load a model with Linear layers of the encoder and decoder dynamically quantized to int8, for CPU inference.
+    Quantized models are cached in cache_dir, keyed by the model's revision, so that the conversion is done only
+    on the first load. The cached file holds the configs and the quantized state dict, loaded with weights_only.
+    """
+    if quantize != "int8":
+        raise ValueError(f'quantize must be either None or "int8", instead got: {quantize}')
+
+    path = get_quantized_model_path(pretrained_model_name_or_path, cache_dir)
+    if path.is_file():
+        logger.info(f"Loading quantized model from {path}")
+        return _load_quantized_state(model_cls, torch.load(path, weights_only=True))
+
+    model = model_cls.from_pretrained(pretrained_model_name_or_path, **kwargs).eval()
+    logger.info("Quantizing model")
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    # the revision of a model from the hub may be known only after it's downloaded
+    path = get_quantized_model_path(pretrained_model_name_or_path, cache_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    state = {
+        "config": model.config.to_dict(),
+        "generation_config": model.generation_config.to_dict(),
+        "state_dict": model.state_dict(),
+    }
+    # written under a temporary name and renamed, so that processes quantizing the model at once don't clash
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f"Saved quantized model to {path}")
+
+    return model
+
+
+def _load_quantized_state(model_cls, state):
+    """
+    Build a model with the same layers as quantize_dynamic gives, without initializing weights, and load the saved
+    quantized state dict into it.
+    """
+    with init_empty_weights():
+        model = model_cls(model_cls.config_class.from_dict(state["config"]))
+    model.generation_config = GenerationConfig.from_dict(state["generation_config"])
+
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if type(child) is nn.Linear:
+                quantized = DynamicQuantizedLinear(
+                    child.in_features, child.out_features, bias_=child.bias is not None, dtype=torch.qint8
+                )
+                setattr(module, name, quantized)
+
+    model.load_state_dict(state["state_dict"], assign=True)
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"Missing weights in quantized model: {missing}")
+
+    return model.eval()
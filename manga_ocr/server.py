@@ -0,0 +1,308 @@
+import asyncio
+import base64
+import binascii
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from loguru import logger
+from PIL import Image, UnidentifiedImageError
+
+from manga_ocr.metrics import Histogram
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+MAX_BODY_SIZE = 64 * 2**20
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+class OcrServer:
+    """
+    HTTP server running OCR with a single MangaOcr instance. Images from concurrent requests are gathered in a bounded
+    queue and recognized together in batches. A batch starts when batch_size images are waiting, or max_wait_ms after
+    the first of them arrived. Requests which don't fit in the queue are rejected with 429 Too Many Requests,
+    and ones with more images than the whole queue holds with 413 Request Entity Too Large.
+
+    Endpoints:
+        POST /ocr with an image file as the body returns {"text": ...}.
+        POST /ocr with JSON {"images": [base64 encoded image files]} returns {"texts": [...]}.
+        GET /metrics returns latency histograms and counters in Prometheus text format.
+    """
+
+    def __init__(self, mocr, batch_size=16, max_wait_ms=10, max_queue_size=64, timeout_secs=30.0):
+        """
+        :param mocr: MangaOcr instance.
+        :param batch_size: Maximum number of images recognized at once.
+        :param max_wait_ms: How long to wait for more images before recognizing an incomplete batch.
+        :param max_queue_size: Maximum number of images waiting for recognition.
+        :param timeout_secs: Requests not finished in this time are answered with 504 Gateway Timeout.
+        """
+        self.mocr = mocr
+        self.batch_size = batch_size
+        self.max_wait_secs = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.timeout_secs = timeout_secs
+
+        self.queue = None
+        self._batch_full = None
+        # inference runs in a single thread, so that the event loop is free to accept and queue new requests meanwhile
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="ocr")
+
+        self.responses = {}
+        self.request_latency = Histogram(
+            "manga_ocr_request_duration_seconds",
+            "Time from receiving a request to sending a response.",
+            LATENCY_BUCKETS,
+        )
+        self.queue_latency = Histogram(
+            "manga_ocr_queue_duration_seconds", "Time images wait in queue before recognition.", LATENCY_BUCKETS
+        )
+        self.batch_latency = Histogram(
+            "manga_ocr_batch_duration_seconds", "Time of recognizing a single batch.", LATENCY_BUCKETS
+        )
+        self.batch_sizes = Histogram(
+            "manga_ocr_server_batch_size", "Number of images in batches formed by the server.", BATCH_SIZE_BUCKETS
+        )
+
+    async def start(self, host="127.0.0.1", port=8000):
+        """
+        Start accepting connections and return asyncio.Server.
+        """
+        self.queue = asyncio.Queue()
+        self._batch_full = asyncio.Event()
+        self._batch_task = asyncio.create_task(self._batch_loop())
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        for sock in self._server.sockets:
+            logger.info(f"Serving on http://{sock.getsockname()[0]}:{sock.getsockname()[1]}")
+        return self._server
+
+    async def close(self):
+        """
+        Stop accepting connections and recognizing queued images.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        self._batch_task.cancel()
+        self._executor.shutdown()
+
+    async def serve_forever(self, host="127.0.0.1", port=8000):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            if self.queue.qsize() < self.batch_size - 1:
+                self._batch_full.clear()
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.max_wait_secs)
+                except asyncio.TimeoutError:
+                    pass
+            while len(items) < self.batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+
+            # skip images of requests which timed out in the meantime
+            items = [(img, future, queued_at) for img, future, queued_at in items if not future.done()]
+            if not items:
+                continue
+
+            t0 = time.monotonic()
+            for _, _, queued_at in items:
+                self.queue_latency.observe(t0 - queued_at)
+
+            imgs = [img for img, _, _ in items]
+            try:
+                texts = await loop.run_in_executor(self._executor, self.mocr.batch, imgs, self.batch_size)
+            except Exception as e:
+                logger.exception(f"Error while recognizing {len(imgs)} images")
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batch_latency.observe(time.monotonic() - t0)
+            self.batch_sizes.observe(len(imgs))
+            for (_, future, _), text in zip(items, texts):
+                if not future.done():
+                    future.set_result(text)
+
+    async def recognize(self, imgs):
+        """
+        Queue images for recognition and wait for the results.
+        """
+        if len(imgs) > self.max_queue_size:
+            # such a request would never fit in the queue, so retrying it wouldn't help
+            raise HttpError(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Too many images ({len(imgs)}), at most {self.max_queue_size}"
+            )
+        if self.queue.qsize() + len(imgs) > self.max_queue_size:
+            raise HttpError(HTTPStatus.TOO_MANY_REQUESTS, f"Queue is full ({self.queue.qsize()} images waiting)")
+
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in imgs]
+        for img, future in zip(imgs, futures):
+            self.queue.put_nowait((img, future, time.monotonic()))
+        if self.queue.qsize() >= self.batch_size - 1:
+            self._batch_full.set()
+
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futures), self.timeout_secs)
+        except asyncio.TimeoutError:
+            raise HttpError(HTTPStatus.GATEWAY_TIMEOUT, f"Not finished in {self.timeout_secs} s")
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                t0 = time.monotonic()
+
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                method = path = version = ""
+                try:
+                    try:
+                        method, path, version = request_line.decode("latin-1").split()
+                        length = int(headers.get("content-length", 0))
+                        if length < 0:
+                            raise ValueError(length)
+                    except ValueError:
+                        headers["connection"] = "close"
+                        raise HttpError(HTTPStatus.BAD_REQUEST, "Malformed request")
+                    status, content_type, body = await self._handle_request(method, path, headers, length, reader)
+                except HttpError as e:
+                    status, content_type, body = e.status, "application/json", json.dumps({"error": str(e)}).encode()
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception:
+                    logger.exception(f"Error while handling {method} {path}")
+                    status, content_type = HTTPStatus.INTERNAL_SERVER_ERROR, "application/json"
+                    body = json.dumps({"error": HTTPStatus.INTERNAL_SERVER_ERROR.phrase}).encode()
+                    headers["connection"] = "close"
+
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + body
+                )
+                await writer.drain()
+
+                self.responses[status.value] = self.responses.get(status.value, 0) + 1
+                if path.startswith("/ocr"):
+                    self.request_latency.observe(time.monotonic() - t0)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, method, path, headers, length, reader):
+        if "transfer-encoding" in headers:
+            headers["connection"] = "close"
+            raise HttpError(HTTPStatus.LENGTH_REQUIRED)
+        if length > MAX_BODY_SIZE:
+            headers["connection"] = "close"
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length)
+
+        if path == "/metrics" and method == "GET":
+            return HTTPStatus.OK, "text/plain; version=0.0.4", self.render_metrics().encode()
+
+        if path == "/ocr" and method == "POST":
+            loop = asyncio.get_running_loop()
+            if headers.get("content-type", "").startswith("application/json"):
+                imgs = await loop.run_in_executor(None, self._decode_json, body)
+                result = {"texts": await self.recognize(imgs)}
+            else:
+                imgs = await loop.run_in_executor(None, self._decode_images, [body])
+                result = {"text": (await self.recognize(imgs))[0]}
+            return HTTPStatus.OK, "application/json", json.dumps(result, ensure_ascii=False).encode()
+
+        if path in ("/ocr", "/metrics"):
+            raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED)
+        raise HttpError(HTTPStatus.NOT_FOUND)
+
+    def _decode_json(self, body):
+        try:
+            files = [base64.b64decode(x, validate=True) for x in json.loads(body)["images"]]
+        except (ValueError, KeyError, TypeError, binascii.Error) as e:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f'Expected JSON {{"images": [base64 encoded images]}}: {e}')
+        if not files:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "No images")
+        return self._decode_images(files)
+
+    def _decode_images(self, files):
+        imgs = []
+        for i, file in enumerate(files):
+            try:
+                imgs.append(self.mocr._read_image(Image.open(io.BytesIO(file))))
+            except (UnidentifiedImageError, OSError) as e:
+                raise HttpError(HTTPStatus.BAD_REQUEST, f"Can't read image {i}: {e}")
+        return imgs
+
+    def render_metrics(self):
+        lines = [
+            "# HELP manga_ocr_responses_total Number of responses by status code.",
+            "# TYPE manga_ocr_responses_total counter",
+            *[f'manga_ocr_responses_total{{code="{code}"}} {count}' for code, count in sorted(self.responses.items())],
+            "# HELP manga_ocr_queue_size Number of images waiting for recognition.",
+            "# TYPE manga_ocr_queue_size gauge",
+            f"manga_ocr_queue_size {self.queue.qsize()}",
+        ]
+        for histogram in [self.request_latency, self.queue_latency, self.batch_latency, self.batch_sizes]:
+            lines += histogram.render()
+        text = "\n".join(lines) + "\n"
+        if self.mocr.metrics is not None:
+            text += self.mocr.metrics.render_prometheus()
+        return text
+
+
+def serve(
+    host="127.0.0.1",
+    port=8000,
+    pretrained_model_name_or_path="kha-white/manga-ocr-base",
+    force_cpu=False,
+    batch_size=16,
+    max_wait_ms=10,
+    max_queue_size=64,
+    timeout_secs=30.0,
+    stage_metrics=False,
+):
+    """
+    Run a local HTTP server for OCR. POST an image file to /ocr to get {"text": ...},
+    or JSON {"images": [base64 encoded image files]} to get {"texts": [...]}. GET /metrics for Prometheus metrics.
+
+    :param host: Address to listen on.
+    :param port: Port to listen on.
+    :param pretrained_model_name_or_path: Path to a trained model, either local or from Transformers' model hub.
+    :param force_cpu: If True, OCR will use CPU even if GPU is available.
+    :param batch_size: Maximum number of images from concurrent requests recognized at once.
+    :param max_wait_ms: How long to wait for more images before recognizing an incomplete batch.
+    :param max_queue_size: Maximum number of images waiting for recognition, requests over it get 429,
+        or 413 if they have more images than that.
+    :param timeout_secs: Requests not finished in this time get 504.
+    :param stage_metrics: If True, /metrics also reports timings of OCR stages, see manga_ocr.metrics.OcrMetrics.
+    """
+    from manga_ocr import MangaOcr
+    from manga_ocr.metrics import OcrMetrics
+
+    mocr = MangaOcr(pretrained_model_name_or_path, force_cpu, metrics=OcrMetrics() if stage_metrics else None)
+    server = OcrServer(mocr, batch_size, max_wait_ms, max_queue_size, timeout_secs)
+    asyncio.run(server.serve_forever(host, port))
@@ -0,0 +1,134 @@
+import json
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+from loguru import logger
+from safetensors.torch import save_file
+from torch import nn
+from transformers import GenerationConfig
+
+from manga_ocr.cache import model_revision
+
+MMAP_MODELS_DIR = Path("~/.cache/manga_ocr/mmap").expanduser()
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def get_mmap_model_dir(pretrained_model_name_or_path, cache_dir=MMAP_MODELS_DIR):
+    name = re.sub(r"[^\w.-]+", "_", str(pretrained_model_name_or_path)).strip("_")
+    # a new commit of a model from the hub, or an overwritten local model, gets a new directory
+    name += f"-{model_revision(pretrained_model_name_or_path)}"
+    return Path(cache_dir) / name
+
+
+def prepare_mmap_weights(model_cls, pretrained_model_name_or_path, cache_dir=MMAP_MODELS_DIR, **kwargs):
+    """
+    Save weights of a model to a single safetensors file in cache_dir, if not saved already, and return the directory
+    containing it. Call this in the parent process before starting workers, so that they don't all convert the model.
+    """
+    model_dir = get_mmap_model_dir(pretrained_model_name_or_path, cache_dir)
+    path = model_dir / "model.safetensors"
+    if path.is_file():
+        return model_dir
+
+    logger.info(f"Saving weights for memory mapping to {path}")
+    model = model_cls.from_pretrained(pretrained_model_name_or_path, **kwargs)
+    model.generation_config.save_pretrained(model_dir)
+
+    # tied weights share storage, save them only once and re-tie after loading
+    state_dict = {}
+    data_ptrs = set()
+    for key, value in model.state_dict().items():
+        if value.data_ptr() not in data_ptrs:
+            data_ptrs.add(value.data_ptr())
+            state_dict[key] = value.contiguous()
+
+    # written under a temporary name and renamed, so that processes converting the model at once don't clash
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+    save_file(state_dict, tmp_path, metadata={"format": "pt"})
+    os.replace(tmp_path, path)
+
+    return model_dir
+
+
+def load_mmap_state_dict(path):
+    """
+    Load a safetensors file as tensors backed directly by a memory-mapped file, without copying the data.
+    Pages of the file are shared between all processes which map it, as long as the tensors are not modified.
+    """
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+        # private mapping: writable for torch, but pages are copied only if something actually writes to them
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    state_dict = {}
+    for key, info in header.items():
+        if key == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // dtype.itemsize
+        offset = 8 + header_size + start
+        state_dict[key] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=offset).view(info["shape"])
+
+    return state_dict
+
+
+@contextmanager
+def init_empty_weights():
+    """
+    Create parameters on meta device, without allocating memory for them. Buffers, which are not saved in
+    checkpoints (e.g. position ids), are still created normally.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        if param is not None:
+            param = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def load_mmap_model(model_cls, pretrained_model_name_or_path, cache_dir=MMAP_MODELS_DIR, **kwargs):
+    """
+    Load a model for CPU inference, with weights memory-mapped from a safetensors file prepared with
+    prepare_mmap_weights. Processes loading the same model share a single copy of the weights in memory.
+    """
+    model_dir = prepare_mmap_weights(model_cls, pretrained_model_name_or_path, cache_dir, **kwargs)
+    path = model_dir / "model.safetensors"
+    config = model_cls.config_class.from_pretrained(pretrained_model_name_or_path, **kwargs)
+
+    with init_empty_weights():
+        model = model_cls(config)
+    model.generation_config = GenerationConfig.from_pretrained(model_dir)
+
+    logger.info(f"Memory-mapping weights from {path}")
+    model.load_state_dict(load_mmap_state_dict(path), strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"Missing weights in {path}: {missing}")
+
+    return model.eval()
@@ -0,0 +1,46 @@
+import os
+
+import torch
+from loguru import logger
+
+
+def set_torch_threads(num_threads=None, interop_threads=None):
+    """
+    Set numbers of torch's intra-op threads, used within a single operation, and inter-op threads.
+    Both are settings of the whole process. Inter-op threads can be set only before any inter-op work started,
+    later attempts are ignored with a warning.
+    """
+    if num_threads is not None and num_threads != torch.get_num_threads():
+        torch.set_num_threads(num_threads)
+
+    if interop_threads is not None and interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            logger.warning(
+                f"Can't set interop_threads={interop_threads} after inter-op parallel work has started, "
+                f"using {torch.get_num_interop_threads()} threads"
+            )
+
+
+def set_cpu_affinity(cpus):
+    """
+    Pin the calling thread to given CPUs. Threads started by it later, like torch's intra-op worker threads,
+    inherit the affinity. Supported only on Linux, ignored with a warning elsewhere.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU affinity is supported only on Linux, ignoring it")
+        return
+    os.sched_setaffinity(0, cpus)
+
+
+def split_cpus(num_parts):
+    """
+    Split CPUs available to the process into num_parts contiguous sets, e.g. for workers which shouldn't compete
+    for the same cores. If there are fewer CPUs than parts, some parts share a CPU.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    return [
+        cpus[i * len(cpus) // num_parts : (i + 1) * len(cpus) // num_parts] or [cpus[i % len(cpus)]]
+        for i in range(num_parts)
+    ]
@@ -0,0 +1,206 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from collections import OrderedDict
+from itertools import islice
+from pathlib import Path
+
+from loguru import logger
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# in polling mode, files overwritten in place don't change directory's mtime, so recently reported files are checked
+# on every poll, and the rest only by an occasional full scan
+NUM_RECENT_CHECKED = 64
+FULL_SCAN_SECS = 10.0
+
+
+class _Inotify:
+    """
+    Minimal inotify binding for watching new files in a single directory.
+    """
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds (forever if None) for events and return names of changed files,
+        or None if the event queue overflowed and some events were lost.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            names.append(os.fsdecode(data[offset : offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _changed_ns(stat):
+    """
+    Time of the last change of a file. Files moved or extracted into the directory keep their old mtime,
+    but moving a file updates its ctime. On Windows, st_ctime is the creation time, updated when a file is copied,
+    but not when it's moved within the same volume.
+    """
+    return max(stat.st_mtime_ns, stat.st_ctime_ns)
+
+
+class DirectoryWatcher:
+    """
+    Watches a directory for new or modified files, using inotify on Linux and polling elsewhere.
+
+    Files which exist when the watcher is created are ignored. A file is reported only once its size and mtime
+    haven't changed for delay_secs, so that partially written files aren't read. Reported files are remembered
+    only up to max_seen most recent ones, older ones are recognized by their mtime and ctime instead.
+    """
+
+    def __init__(self, path, delay_secs=0.1, max_seen=10000, use_inotify=None):
+        """
+        :param path: Directory to watch.
+        :param delay_secs: How long a file has to stay unchanged to be reported, and how often to poll in polling mode.
+        :param max_seen: How many reported files to remember.
+        :param use_inotify: If None, use inotify if available.
+        """
+        self.path = Path(path)
+        self.delay_secs = delay_secs
+        self.max_seen = max_seen
+
+        # path -> (mtime_ns, size) of reported files, and the newest change time of files forgotten from it
+        self.seen = OrderedDict()
+        self.min_mtime_ns = time.time_ns()
+        # path -> ((mtime_ns, size), time of the last change) of files waiting to become stable
+        self.pending = {}
+
+        self._inotify = None
+        if use_inotify is None:
+            use_inotify = sys.platform.startswith("linux")
+        if use_inotify:
+            try:
+                self._inotify = _Inotify(self.path)
+            except OSError as e:
+                logger.warning(f"Can't use inotify, falling back to polling: {e}")
+
+        self._dir_mtime_ns = self.path.stat().st_mtime_ns
+        self._last_full_scan = time.monotonic()
+
+    def poll(self):
+        """
+        Wait for changes and return a list of new files, which are ready to be read. Can be empty.
+        """
+        timeout = self.delay_secs if self.pending else None
+
+        if self._inotify is not None:
+            names = self._inotify.read(timeout)
+            if names is None:
+                logger.warning("Too many file events, rescanning directory")
+                self._scan()
+            else:
+                for name in names:
+                    self._add_candidate(self.path / name)
+        else:
+            time.sleep(self.delay_secs)
+            dir_mtime_ns = self.path.stat().st_mtime_ns
+            if dir_mtime_ns != self._dir_mtime_ns or time.monotonic() - self._last_full_scan > FULL_SCAN_SECS:
+                self._dir_mtime_ns = dir_mtime_ns
+                self._scan()
+            else:
+                for path in islice(reversed(self.seen), NUM_RECENT_CHECKED):
+                    self._add_candidate(path)
+
+        return self._pop_ready()
+
+    def _scan(self):
+        self._last_full_scan = time.monotonic()
+        with os.scandir(self.path) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if _changed_ns(stat) > self.min_mtime_ns:
+                    self._add_candidate(Path(entry.path))
+
+    def _add_candidate(self, path):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        key = (stat.st_mtime_ns, stat.st_size)
+        if path.is_file() and self.seen.get(path) != key and path not in self.pending:
+            self.pending[path] = (key, time.monotonic())
+
+    def _pop_ready(self):
+        ready = []
+        now = time.monotonic()
+        for path, (key, changed_at) in list(self.pending.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+
+            new_key = (stat.st_mtime_ns, stat.st_size)
+            if new_key != key:
+                self.pending[path] = (new_key, now)
+            elif now - changed_at >= self.delay_secs:
+                del self.pending[path]
+                self._mark_seen(path, key)
+                ready.append(path)
+
+        return sorted(ready)
+
+    def _mark_seen(self, path, key):
+        self.seen.pop(path, None)
+        self.seen[path] = key
+        while len(self.seen) > self.max_seen:
+            old_path, (mtime_ns, _) = self.seen.popitem(last=False)
+            try:
+                mtime_ns = max(mtime_ns, _changed_ns(old_path.stat()))
+            except FileNotFoundError:
+                pass
+            self.min_mtime_ns = max(self.min_mtime_ns, mtime_ns)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
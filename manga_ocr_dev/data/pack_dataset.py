@@ -0,0 +1,84 @@
+from pathlib import Path
+
+import fire
+import pandas as pd
+from tqdm import tqdm
+
+from manga_ocr_dev.env import DATA_PACKED_ROOT, DATA_SYNTHETIC_ROOT, MANGA109_ROOT
+
+INDEX_COLUMNS = ["shard", "offset", "size", "text", "synthetic", "package", "split"]
+
+
+def get_samples(packages=None):
+    """
+    List all samples used by MangaDataset: synthetic packages with their images, followed by Manga109 crops
+    of both splits.
+    """
+    data = []
+    for path in sorted((DATA_SYNTHETIC_ROOT / "meta").glob("*.csv")):
+        if packages is not None and int(path.stem) not in packages:
+            continue
+        if not (DATA_SYNTHETIC_ROOT / "img" / path.stem).is_dir():
+            print(f"Missing image data for package {path}, skipping")
+            continue
+        df = pd.read_csv(path)
+        df = df.dropna()
+        img_dir = DATA_SYNTHETIC_ROOT / "img" / path.stem
+        df["path"] = [str(img_dir / f"{x}.jpg") for x in df.id]
+        df["synthetic"] = True
+        df["package"] = path.stem
+        df["split"] = ""
+        data.append(df[["path", "text", "synthetic", "package", "split"]])
+
+    df = pd.read_csv(MANGA109_ROOT / "data.csv")
+    df["path"] = df.crop_path.apply(lambda x: str(MANGA109_ROOT / x))
+    df["synthetic"] = False
+    df["package"] = "manga109"
+    data.append(df[["path", "text", "synthetic", "package", "split"]])
+
+    return pd.concat(data, ignore_index=True)
+
+
+def pack_dataset(output_root=DATA_PACKED_ROOT, shard_size_mb=1024, packages=None, seed=0):
+    """
+    Pack images of the training data into large shard files, so that training reads a few big files
+    sequentially instead of millions of small ones.
+
+    Shards shard_00000.bin, shard_00001.bin etc. are concatenated image files, kept in their original encoding.
+    index.csv lists samples in order of shards, with their shard, offset and size in bytes, text, and whether
+    they are synthetic, together with the package and split used to select them, see PackedMangaDataset.
+
+    Samples are shuffled before packing, so that each shard is a random mix of all packages and Manga109:
+    ShardShuffleSampler shuffles samples only within shards, so batches are only as mixed as the shards are.
+
+    :param output_root: Directory to write shards and index to.
+    :param shard_size_mb: A new shard is started when the current one exceeds this size.
+    :param packages: Optional numbers of synthetic packages to pack, all by default.
+    :param seed: Seed of the order of samples in shards.
+    """
+    output_root = Path(output_root)
+    output_root.mkdir(parents=True, exist_ok=True)
+    samples = get_samples(packages).sample(frac=1, random_state=seed)
+
+    index = []
+    shard = 0
+    samples = iter(tqdm(samples.itertuples(), total=len(samples)))
+    for sample in samples:
+        with open(output_root / f"shard_{shard:05d}.bin", "wb") as f:
+            offset = 0
+            while sample is not None:
+                data = Path(sample.path).read_bytes()
+                f.write(data)
+                index.append((shard, offset, len(data), sample.text, sample.synthetic, sample.package, sample.split))
+                offset += len(data)
+                if offset >= shard_size_mb * 2**20:
+                    break
+                sample = next(samples, None)
+        shard += 1
+
+    pd.DataFrame(index, columns=INDEX_COLUMNS).to_csv(output_root / "index.csv", index=False)
+    print(f"Packed {len(index)} samples into {shard} shards in {output_root}")
+
+
+if __name__ == "__main__":
+    fire.Fire(pack_dataset)
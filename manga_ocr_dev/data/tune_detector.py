@@ -0,0 +1,88 @@
+import cv2
+import fire
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from manga_ocr.detection import DETECTOR_PARAMS, detect_text_regions
+from manga_ocr_dev.env import MANGA109_ROOT
+
+# values tried for each parameter, the rest is left at defaults
+PARAM_GRID = {
+    "min_ink": [0.02, 0.03, 0.05],
+    "glyph_size": [0.02, 0.03, 0.04],
+    "min_fill": [0.25, 0.35, 0.45],
+    "min_region_cells": [4, 8, 16],
+    "max_glyph_ink": [0.4, 0.5, 0.6],
+    "min_white_border": [0.4, 0.6, 0.8],
+}
+
+
+def iou_matrix(a, b):
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(1, -1, 4)
+    w = (np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])).clip(0)
+    h = (np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])).clip(0)
+    intersection = w * h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return intersection / (area_a + area_b - intersection)
+
+
+def evaluate(pages, params, min_iou):
+    """
+    Return precision and recall of detected boxes, where a detection matches an annotated text box with IoU >= min_iou.
+    """
+    num_detected = num_annotated = num_found = num_correct = 0
+    for gray, boxes in pages:
+        detected = detect_text_regions(gray, **params)
+        num_detected += len(detected)
+        num_annotated += len(boxes)
+        if detected and boxes:
+            matches = iou_matrix(detected, boxes) >= min_iou
+            num_correct += matches.any(axis=1).sum()
+            num_found += matches.any(axis=0).sum()
+
+    return num_correct / max(num_detected, 1), num_found / max(num_annotated, 1)
+
+
+def tune_detector(num_pages=200, min_iou=0.5, seed=0):
+    """
+    Grid search of text detector parameters on Manga109-s text boxes, exported by process_manga109s.py.
+    Each parameter from PARAM_GRID is tuned separately, in order, keeping the best values of the previous ones.
+    Pages are sampled from the test split.
+
+    :param num_pages: Number of pages to evaluate on.
+    :param min_iou: IoU with an annotated box, for which a detected box is counted as correct.
+    :param seed: Random seed for sampling pages.
+    """
+    data = pd.read_csv(MANGA109_ROOT / "data.csv")
+    data = data[data.split == "test"]
+    page_paths = pd.Series(data.page_path.unique()).sample(num_pages, random_state=seed)
+
+    pages = []
+    for page_path in tqdm(page_paths, desc="loading pages"):
+        gray = cv2.imread(str(MANGA109_ROOT / page_path), cv2.IMREAD_GRAYSCALE)
+        boxes = data[data.page_path == page_path][["xmin", "ymin", "xmax", "ymax"]].values.tolist()
+        pages.append((gray, boxes))
+
+    def f1(params):
+        precision, recall = evaluate(pages, params, min_iou)
+        return 2 * precision * recall / max(precision + recall, 1e-9), precision, recall
+
+    best = dict(DETECTOR_PARAMS)
+    print(f"defaults: F1 {f1(best)[0]:.3f}")
+    for name, values in PARAM_GRID.items():
+        results = {value: f1({**best, name: value}) for value in values}
+        best[name] = max(results, key=lambda value: results[value][0])
+        for value, (score, precision, recall) in results.items():
+            print(f"{name}={value}: F1 {score:.3f}, precision {precision:.3f}, recall {recall:.3f}")
+
+    score, precision, recall = f1(best)
+    print(f"best: F1 {score:.3f}, precision {precision:.3f}, recall {recall:.3f}")
+    for name, value in best.items():
+        print(f'    "{name}": {value},')
+
+
+if __name__ == "__main__":
+    fire.Fire(tune_detector)
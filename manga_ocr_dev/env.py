@@ -4,6 +4,8 @@ ASSETS_PATH = Path(__file__).parent.parent / "assets"
 
 FONTS_ROOT = Path("~/data/jp_fonts").expanduser()
 DATA_SYNTHETIC_ROOT = Path("~/data/manga/synthetic").expanduser()
+DATA_PACKED_ROOT = Path("~/data/manga/packed").expanduser()
+EVAL_CACHE_ROOT = Path("~/data/manga/eval_cache").expanduser()
 BACKGROUND_DIR = Path("~/data/manga/Manga109s/background").expanduser()
 MANGA109_ROOT = Path("~/data/manga/Manga109s").expanduser()
 TRAIN_ROOT = Path("~/data/manga/out").expanduser()
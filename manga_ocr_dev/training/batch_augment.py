@@ -0,0 +1,340 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# same policies as MangaDataset.get_transforms, in the same order: probability of each transform and its parameters
+MEDIUM_POLICY = {
+    "rotate_p": 0.2,
+    "rotate_limit": 5,
+    "perspective_p": 0.2,
+    "perspective_scale": (0.01, 0.05),
+    "invert_p": 0.05,
+    "downscale_p": 0.1,
+    "downscale_scale": (0.25, 0.5),
+    "blur_p": 0.2,
+    "blur_limit": (3, 7),
+    "sharpen_p": 0.2,
+    "brightness_contrast_p": 0.5,
+    "brightness_contrast_limit": (0.2, 0.2),
+    "noise_p": 0.3,
+    "noise_var": (50, 200),
+    "jpeg_p": 0.1,
+    "jpeg_quality": (0, 30),
+}
+
+HEAVY_POLICY = {
+    "rotate_p": 0.2,
+    "rotate_limit": 10,
+    "perspective_p": 0.2,
+    "perspective_scale": (0.01, 0.05),
+    "invert_p": 0.05,
+    "downscale_p": 0.1,
+    "downscale_scale": (0.1, 0.2),
+    "blur_p": 0.5,
+    "blur_limit": (4, 9),
+    "sharpen_p": 0.5,
+    "brightness_contrast_p": 1.0,
+    "brightness_contrast_limit": (0.8, 0.8),
+    "noise_p": 0.3,
+    "noise_var": (1000, 10000),
+    "jpeg_p": 0.5,
+    "jpeg_quality": (0, 10),
+}
+
+# samples without augmentation: same parameters, applied with probability 0
+NO_POLICY = {key: 0.0 if key.endswith("_p") else value for key, value in MEDIUM_POLICY.items()}
+
+# torch interpolation modes closest to PIL resampling filters used by processors
+RESIZE_MODES = {
+    Image.Resampling.NEAREST: "nearest",
+    Image.Resampling.BILINEAR: "bilinear",
+    Image.Resampling.BICUBIC: "bicubic",
+}
+
+# weights of cv2.COLOR_RGB2GRAY
+GRAY_WEIGHTS = torch.tensor([0.299, 0.587, 0.114])
+
+JPEG_LUMA_TABLE = torch.tensor(
+    [
+        [16, 11, 10, 16, 24, 40, 51, 61],
+        [12, 12, 14, 19, 26, 58, 60, 55],
+        [14, 13, 16, 24, 40, 57, 69, 56],
+        [14, 17, 22, 29, 51, 87, 80, 62],
+        [18, 22, 37, 56, 68, 109, 103, 77],
+        [24, 35, 55, 64, 81, 104, 113, 92],
+        [49, 64, 78, 87, 103, 121, 120, 101],
+        [72, 92, 95, 98, 112, 100, 103, 99],
+    ],
+    dtype=torch.float32,
+)
+
+
+class BatchAugmenter:
+    """
+    Augmentation of whole batches of pixel values on the device they're on, e.g. GPU, after collation, instead of
+    albumentations in dataloader workers. Each sample gets the medium or heavy policy of MangaDataset.get_transforms
+    with the same probabilities, and their transforms are applied with the same probabilities and parameters.
+
+    Samples come already resized by the processor, so transforms whose effect depends on resolution use the size
+    of images before resizing, returned by MangaDataset with batch_augment=True as image_size: blur is scaled to it,
+    and downscale, sharpen, noise and JPEG compression, applied to a part of samples, are applied to each of them
+    resized back to it.
+    See manga_ocr_dev/training/compare_augmentation.py for comparison of both.
+    """
+
+    def __init__(self, feature_extractor, medium_p=0.8, heavy_p=0.02):
+        """
+        :param feature_extractor: Image processor which prepared the pixel values, to undo its normalization
+            and get its resize and center crop sizes.
+        :param medium_p: Probability of the medium policy.
+        :param heavy_p: Probability of the heavy policy.
+        """
+        self.mean = torch.tensor(feature_extractor.image_mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(feature_extractor.image_std).view(1, -1, 1, 1)
+        self.resize_size = (feature_extractor.size["height"], feature_extractor.size["width"])
+        if getattr(feature_extractor, "do_center_crop", False):
+            crop_size = (feature_extractor.crop_size["height"], feature_extractor.crop_size["width"])
+        else:
+            crop_size = self.resize_size
+        # fraction of the resized image kept by the center crop
+        self.crop_fraction = torch.tensor([crop_size[0] / self.resize_size[0], crop_size[1] / self.resize_size[1]])
+        self.resize_mode = RESIZE_MODES.get(feature_extractor.resample, "bilinear")
+
+        self.policy_p = torch.tensor([1 - medium_p - heavy_p, medium_p, heavy_p], dtype=torch.float32)
+        self.policies = {
+            key: torch.tensor([NO_POLICY[key], MEDIUM_POLICY[key], HEAVY_POLICY[key]], dtype=torch.float32)
+            for key in MEDIUM_POLICY
+        }
+
+    def __call__(self, pixel_values, image_size=None):
+        """
+        :param pixel_values: Batch of pixel values of grayscale images, as prepared by the processor.
+        :param image_size: Height and width of each image before resizing. If None, images are treated
+            as if they had the processor's size.
+        :return: Augmented pixel values.
+        """
+        device = pixel_values.device
+        mean, std = self.mean.to(device), self.std.to(device)
+        x = pixel_values[:, :1].float() * std[:, :1] + mean[:, :1]
+        if image_size is None:
+            image_size = torch.tensor(self.resize_size, device=device).expand(len(x), 2)
+        image_size = image_size.to(device=device, dtype=torch.float32)
+        # how many original pixels of each axis make a pixel of the resized image
+        scale = image_size / torch.tensor(self.resize_size, device=device)
+
+        variant = torch.multinomial(self.policy_p, len(x), replacement=True)
+        params = {key: value[variant].to(device) for key, value in self.policies.items()}
+
+        def apply(key):
+            return torch.rand(len(x), device=device) < params[f"{key}_p"]
+
+        if (mask := apply("rotate")).any():
+            x[mask] = self.rotate(x[mask], params["rotate_limit"][mask], image_size[mask])
+        if (mask := apply("perspective")).any():
+            x[mask] = self.perspective(x[mask], params["perspective_scale"][mask])
+        if (mask := apply("invert")).any():
+            x[mask] = 1 - x[mask]
+        if (mask := apply("downscale")).any():
+            x[mask] = self.downscale(x[mask], params["downscale_scale"][mask], image_size[mask])
+        if (mask := apply("blur")).any():
+            x[mask] = self.blur(x[mask], params["blur_limit"][mask], scale[mask])
+        if (mask := apply("sharpen")).any():
+            x[mask] = self.sharpen(x[mask], image_size[mask])
+        if (mask := apply("brightness_contrast")).any():
+            x[mask] = self.brightness_contrast(x[mask], params["brightness_contrast_limit"][mask])
+        if (mask := apply("noise")).any():
+            x[mask] = self.noise(x[mask], params["noise_var"][mask], image_size[mask])
+        if (mask := apply("jpeg")).any():
+            x[mask] = self.jpeg(x[mask], params["jpeg_quality"][mask], image_size[mask])
+
+        return ((x - mean) / std).to(pixel_values.dtype)
+
+    def rotate(self, x, limit, image_size):
+        angle = torch.deg2rad((torch.rand_like(limit) * 2 - 1) * limit)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        # rotation of the original image, in coordinates normalized separately for each axis
+        height, width = (image_size * self.crop_fraction.to(x.device)).unbind(1)
+        theta = torch.zeros(len(x), 2, 3, device=x.device)
+        theta[:, 0, 0], theta[:, 0, 1] = cos, -sin * height / width
+        theta[:, 1, 0], theta[:, 1, 1] = sin * width / height, cos
+        grid = F.affine_grid(theta, x.shape, align_corners=False)
+        return F.grid_sample(x, grid, mode="bilinear", padding_mode="border", align_corners=False)
+
+    def perspective(self, x, scale_range):
+        # corners of the source quadrilateral, stretched to the whole image, as in A.Perspective
+        scale = scale_range[:, 0] + torch.rand(len(x), device=x.device) * (scale_range[:, 1] - scale_range[:, 0])
+        jitter = torch.remainder(torch.abs(torch.randn(len(x), 4, 2, device=x.device) * scale[:, None, None]), 1)
+        corners = torch.tensor([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=torch.float32, device=x.device)
+        src = corners + jitter * (1 - 2 * corners)
+
+        # homography from the unit square to src, as a linear system for its 8 unknown coefficients
+        a = torch.zeros(len(x), 8, 8, device=x.device)
+        u, v = corners[:, 0], corners[:, 1]
+        sx, sy = src[..., 0], src[..., 1]
+        a[:, 0::2, 0], a[:, 0::2, 1], a[:, 0::2, 2] = u, v, 1
+        a[:, 0::2, 6], a[:, 0::2, 7] = -u * sx, -v * sx
+        a[:, 1::2, 3], a[:, 1::2, 4], a[:, 1::2, 5] = u, v, 1
+        a[:, 1::2, 6], a[:, 1::2, 7] = -u * sy, -v * sy
+        b = torch.stack([sx, sy], dim=2).reshape(len(x), 8)
+        h = torch.cat([torch.linalg.solve(a, b), torch.ones(len(x), 1, device=x.device)], dim=1).view(-1, 3, 3)
+
+        identity = torch.eye(2, 3, device=x.device).expand(len(x), 2, 3)
+        grid = F.affine_grid(identity, x.shape, align_corners=False)
+        # from coordinates in the cropped image to the unit square of the whole one, and back
+        crop_fraction = self.crop_fraction.flip(0).to(x.device)
+        points = (grid * crop_fraction + 1) / 2
+        points = torch.cat([points, torch.ones_like(points[..., :1])], dim=-1) @ h[:, None].transpose(-1, -2)
+        points = points[..., :2] / points[..., 2:]
+        grid = (points * 2 - 1) / crop_fraction
+        return F.grid_sample(x, grid, mode="bilinear", padding_mode="border", align_corners=False)
+
+    def original_sizes(self, image_size):
+        # sizes of the parts of images kept by the center crop, before resizing
+        fraction_h, fraction_w = self.crop_fraction.tolist()
+        return [(max(2, round(h * fraction_h)), max(2, round(w * fraction_w))) for h, w in image_size.tolist()]
+
+    def resize(self, img, size):
+        # the same interpolation as the processor's
+        kwargs = {} if self.resize_mode == "nearest" else {"align_corners": False, "antialias": True}
+        return F.interpolate(img, size=size, mode=self.resize_mode, **kwargs)
+
+    def at_original_resolution(self, x, image_size, fn):
+        """
+        Apply fn(imgs, indices) to images resized back to their size before resizing by the processor, for transforms
+        which can't be approximated well at another resolution. Images of the same size are resized and passed to fn
+        together, with indices of them in x. Only the change made by fn is resized to the current size and added,
+        so that details lost by resizing back and forth are kept.
+        """
+        out = torch.empty_like(x)
+        for size, indices in group_indices(self.original_sizes(image_size)).items():
+            indices = torch.tensor(indices, device=x.device)
+            imgs = F.interpolate(x[indices], size=size, mode="bilinear", align_corners=False, antialias=True)
+            out[indices] = x[indices] + self.resize(fn(imgs, indices) - imgs, x.shape[-2:])
+        return torch.clamp(out, 0, 1)
+
+    def downscale(self, x, scale_range, image_size):
+        scale = scale_range[:, 0] + torch.rand(len(x), device=x.device) * (scale_range[:, 1] - scale_range[:, 0])
+        nearest = (torch.rand(len(x)) < 0.5).tolist()
+        sizes = self.original_sizes(image_size)
+        small_sizes = [(max(1, round(h * s)), max(1, round(w * s))) for (h, w), s in zip(sizes, scale.tolist())]
+        out = torch.empty_like(x)
+        for (size, small_size, is_nearest), indices in group_indices(zip(sizes, small_sizes, nearest)).items():
+            # downscaled and upscaled back at the original resolution, by interpolation without antialiasing,
+            # like cv2.resize, and then resized the same way as by the processor
+            mode, kwargs = ("nearest", {}) if is_nearest else ("bilinear", {"align_corners": False})
+            indices = torch.tensor(indices, device=x.device)
+            small = F.interpolate(x[indices], size=small_size, mode=mode, **kwargs)
+            out[indices] = self.resize(F.interpolate(small, size=size, mode=mode, **kwargs), x.shape[-2:])
+        return torch.clamp(out, 0, 1)
+
+    def blur(self, x, limit, scale):
+        # kernel size chosen as in A.Blur, from every other value between the limits, scaled to the current size
+        num_sizes = torch.div(limit[:, 1] - limit[:, 0], 2, rounding_mode="floor") + 1
+        ksize = limit[:, 0] + 2 * torch.floor(torch.rand(len(x), device=x.device) * num_sizes)
+        return box_blur(x, ksize[:, None] / scale)
+
+    def sharpen(self, x, image_size):
+        alpha = 0.2 + torch.rand(len(x), device=x.device) * 0.3
+        lightness = 0.5 + torch.rand(len(x), device=x.device) * 0.5
+        kernel = torch.full((len(x), 1, 3, 3), -1.0, device=x.device)
+        kernel[..., 1, 1] = 8 + lightness[:, None]
+        identity = torch.zeros_like(kernel)
+        identity[..., 1, 1] = 1
+        kernel = (1 - alpha[:, None, None, None]) * identity + alpha[:, None, None, None] * kernel
+
+        def sharpen_image(imgs, indices):
+            # each image convolved with its own kernel, as a group of a single batch item
+            n, _, height, width = imgs.shape
+            padded = F.pad(imgs.view(1, n, height, width), (1, 1, 1, 1), mode="reflect")
+            return torch.clamp(F.conv2d(padded, kernel[indices], groups=n), 0, 1).view_as(imgs)
+
+        return self.at_original_resolution(x, image_size, sharpen_image)
+
+    def brightness_contrast(self, x, limit):
+        alpha = 1 + (torch.rand(len(x), device=x.device) * 2 - 1) * limit[:, 1]
+        beta = (torch.rand(len(x), device=x.device) * 2 - 1) * limit[:, 0]
+        return torch.clamp(x * alpha[:, None, None, None] + beta[:, None, None, None], 0, 1)
+
+    def noise(self, x, var_range, image_size):
+        var = var_range[:, 0] + torch.rand(len(x), device=x.device) * (var_range[:, 1] - var_range[:, 0])
+        sigma = torch.sqrt(var) / 255
+
+        def noise_image(imgs, indices):
+            # noise is independent in each color channel and clipped, before conversion to grayscale
+            noise = sigma[indices, None, None, None] * torch.randn(len(imgs), 3, *imgs.shape[-2:], device=x.device)
+            noisy = torch.clamp(imgs + noise, 0, 1)
+            return (noisy * GRAY_WEIGHTS.to(x.device)[:, None, None]).sum(dim=1, keepdim=True)
+
+        return self.at_original_resolution(x, image_size, noise_image)
+
+    def jpeg(self, x, quality_range, image_size):
+        quality = quality_range[:, 0] + torch.floor(
+            torch.rand(len(x), device=x.device) * (quality_range[:, 1] - quality_range[:, 0] + 1)
+        )
+        return self.at_original_resolution(
+            x, image_size, lambda imgs, indices: jpeg_compress(imgs[:, 0], quality[indices])[:, None]
+        )
+
+
+def group_indices(keys):
+    """
+    Indices of equal keys, grouped by the key, in order of their first occurrence.
+    """
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    return groups
+
+
+def box_blur(x, size):
+    """
+    Blur images of a batch with box filters of given, possibly fractional, widths, for each image and axis,
+    with edges reflected like in cv2.blur.
+
+    :param x: Images, of shape (batch, 1, height, width).
+    :param size: Widths of filters, of shape (batch, 2), in pixels, for vertical and horizontal axis.
+    """
+    size = torch.minimum(torch.clamp(size, min=1), torch.tensor(x.shape[-2:], device=x.device) - 1)
+    radius = math.ceil(size.max().item() / 2)
+    offsets = torch.arange(-radius, radius + 1, device=x.device, dtype=torch.float32)
+    # overlap of each pixel with the box
+    half = size[..., None] / 2
+    weights = torch.clamp(torch.minimum(offsets + 0.5, half) - torch.maximum(offsets - 0.5, -half), min=0)
+    weights = weights / weights.sum(dim=-1, keepdim=True)
+
+    n, _, height, width = x.shape
+    out = F.pad(x.view(1, n, height, width), (0, 0, radius, radius), mode="reflect")
+    out = F.conv2d(out, weights[:, 0, None, :, None], groups=n)
+    out = F.pad(out, (radius, radius, 0, 0), mode="reflect")
+    out = F.conv2d(out, weights[:, 1, None, None, :], groups=n)
+    return out.view_as(x)
+
+
+def jpeg_compress(img, quality):
+    """
+    Lossy part of baseline JPEG compression of grayscale images with values in [0, 1]: quantization of DCT
+    coefficients of 8x8 blocks with the standard luminance table, scaled for quality like in libjpeg.
+
+    :param img: Image of shape (height, width), or images of shape (batch, height, width).
+    :param quality: Quality of all images, or a tensor of shape (batch,) with quality of each one.
+    """
+    quality = torch.clamp(torch.as_tensor(quality, dtype=torch.float32, device=img.device), min=1).view(-1, 1, 1)
+    table_scale = torch.where(quality < 50, 5000 / quality, 200 - 2 * quality)
+    table = torch.clamp(torch.floor((JPEG_LUMA_TABLE.to(img.device) * table_scale + 50) / 100), 1, 255)
+
+    k = torch.arange(8, device=img.device, dtype=torch.float32)
+    dct = torch.cos((2 * k[None, :] + 1) * k[:, None] * math.pi / 16) * math.sqrt(2 / 8)
+    dct[0] /= math.sqrt(2)
+
+    height, width = img.shape[-2:]
+    # edge pixels are repeated to fill the last blocks
+    padded = F.pad(img.reshape(-1, 1, height, width) * 255 - 128, (0, -width % 8, 0, -height % 8), mode="replicate")
+    blocks = padded[:, 0].unfold(1, 8, 8).unfold(2, 8, 8)
+    # a table for each image, the same for all of its blocks
+    table = table[:, None, None]
+    coefficients = torch.round(dct @ blocks @ dct.T / table) * table
+    blocks = dct.T @ coefficients @ dct
+    padded = blocks.permute(0, 1, 3, 2, 4).reshape(len(blocks), *padded.shape[-2:])
+    return (torch.clamp(torch.round(padded[:, :height, :width] + 128), 0, 255) / 255).view(img.shape)
@@ -0,0 +1,58 @@
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+from manga_ocr_dev.training.dataset import MangaDataset, PackedMangaDataset
+from manga_ocr_dev.training.get_model import get_processor
+
+
+def labels_from_dataframe(data, tokenizer, max_target_length, idx):
+    """
+    Baseline: how samples' labels were prepared before, from a DataFrame row, tokenizing the text every time.
+    """
+    sample = data.loc[idx]
+    labels = tokenizer(sample.text, padding="max_length", max_length=max_target_length, truncation=True).input_ids
+    labels = np.array(labels)
+    labels[labels == tokenizer.pad_token_id] = -100
+    return sample.path, labels
+
+
+def benchmark_dataset(
+    encoder_name="facebook/deit-tiny-patch16-224",
+    decoder_name="cl-tohoku/bert-base-japanese-char-v2",
+    max_len=300,
+    num_samples=5000,
+    packed_data_root=None,
+):
+    """
+    Measure samples per second of a single dataloader worker: for labels only, with a DataFrame and tokenization
+    of each sample as before, and with the compact index and pre-tokenized labels, and for whole samples.
+
+    :param packed_data_root: Optional directory with packed data, see PackedMangaDataset.
+    """
+    processor = get_processor(encoder_name, decoder_name)
+    if packed_data_root is None:
+        ds = MangaDataset(processor, "train", max_len)
+        paths = [ds.paths[i] for i in range(len(ds))]
+    else:
+        ds = PackedMangaDataset(processor, "train", max_len, packed_data_root)
+        paths = [""] * len(ds)
+    data = pd.DataFrame({"path": paths, "text": [ds.texts[i] for i in range(len(ds))]})
+
+    indices = np.random.default_rng(0).integers(0, len(ds), min(num_samples, len(ds)))
+    methods = {
+        "labels_dataframe": lambda i: labels_from_dataframe(data, processor.tokenizer, max_len, i),
+        "labels_compact": lambda i: (ds.paths[i] if packed_data_root is None else ds.offset[i], ds.get_labels(i)),
+        "whole_sample": lambda i: ds[i],
+    }
+    for name, method in methods.items():
+        t0 = time.perf_counter()
+        for i in indices:
+            method(i)
+        print(f"{name:<20}{len(indices) / (time.perf_counter() - t0):>10.0f} samples/s")
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_dataset)
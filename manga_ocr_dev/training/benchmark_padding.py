@@ -0,0 +1,83 @@
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+import torch
+
+from manga_ocr_dev.training.dataset import (
+    LengthGroupedSampler,
+    MangaDataset,
+    PackedMangaDataset,
+    dynamic_padding_collator,
+)
+from manga_ocr_dev.training.get_model import get_model
+
+
+def benchmark_padding(
+    encoder_name="facebook/deit-tiny-patch16-224",
+    decoder_name="cl-tohoku/bert-base-japanese-char-v2",
+    max_len=300,
+    num_decoder_layers=2,
+    batch_size=64,
+    num_steps=20,
+    packed_data_root=None,
+):
+    """
+    Compare padding of labels to max_len with dynamic padding, in random batches and in batches grouped by length:
+    label tokens processed per training step, and time of an epoch, estimated from time of num_steps training steps
+    (forward, backward and optimizer step) on batches of the training data. Images are replaced with zeros,
+    so that only the model is measured.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, processor = get_model(encoder_name, decoder_name, max_len, num_decoder_layers)
+    model.to(device).train()
+    optimizer = torch.optim.AdamW(model.parameters())
+
+    if packed_data_root is None:
+        ds = MangaDataset(processor, "train", max_len, pad_labels=False)
+    else:
+        ds = PackedMangaDataset(processor, "train", max_len, Path(packed_data_root), pad_labels=False)
+    lengths = ds.label_lengths()
+    size = processor.feature_extractor.size
+    pixel_values = torch.zeros(batch_size, 3, size["height"], size["width"], device=device)
+
+    orders = {
+        "max_length": np.random.default_rng(0).permutation(len(ds)),
+        "dynamic": np.random.default_rng(0).permutation(len(ds)),
+        "dynamic_grouped": np.fromiter(LengthGroupedSampler(lengths, batch_size), int),
+    }
+    for name, order in orders.items():
+        batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+        if name == "max_length":
+            widths = np.full(len(batches), max_len)
+        else:
+            widths = np.array([-(-lengths[batch].max() // 8) * 8 for batch in batches])
+        tokens_per_step = (widths * np.array([len(batch) for batch in batches])).mean()
+
+        times = []
+        for batch in batches[:num_steps]:
+            features = [{"pixel_values": pixel_values[0], "labels": torch.from_numpy(ds.get_labels(i))} for i in batch]
+            labels = dynamic_padding_collator(features)["labels"]
+            if name == "max_length":
+                labels = torch.nn.functional.pad(labels, (0, max_len - labels.shape[1]), value=-100)
+
+            t0 = time.perf_counter()
+            loss = model(pixel_values=pixel_values[: len(batch)], labels=labels.to(device)).loss
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            if device == "cuda":
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - t0)
+
+        # the first step includes lazy initialization
+        step_secs = np.median(times[1:] if len(times) > 1 else times)
+        print(
+            f"{name:<18}{tokens_per_step:>10.0f} label tokens/step{lengths.sum() / len(batches):>8.0f} non-padding"
+            f"{1000 * step_secs:>10.1f} ms/step{step_secs * len(batches) / 60:>10.1f} min/epoch"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(benchmark_padding)
@@ -0,0 +1,57 @@
+import hashlib
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+
+class StringArray:
+    """
+    Strings stored as a single UTF-8 buffer with an offsets table. Unlike a list or an object column of a DataFrame,
+    it's just two numpy arrays, so dataloader workers forked from the main process share it, instead of copying
+    every string as soon as its reference count is touched.
+    """
+
+    def __init__(self, strings):
+        encoded = [s.encode() for s in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.buffer[self.offsets[idx] : self.offsets[idx + 1]].tobytes().decode()
+
+
+def load_token_ids(tokenizer, texts, csv_path, chunk_size=10000):
+    """
+    Return token ids of texts, with special tokens and without truncation, as a flat int32 array and an offsets table,
+    so that ids of i-th text are token_ids[offsets[i]:offsets[i + 1]].
+
+    Token ids are computed once and saved next to the csv file the texts come from, specific to the tokenizer,
+    and memory-mapped afterwards. They're computed again if the csv file changes.
+    """
+    key = hashlib.md5(f"{tokenizer.name_or_path}:{len(tokenizer)}".encode()).hexdigest()[:8]
+    ids_path = csv_path.with_name(f"{csv_path.stem}.{key}.token_ids.npy")
+    offsets_path = csv_path.with_name(f"{csv_path.stem}.{key}.token_offsets.npy")
+
+    if not offsets_path.is_file() or offsets_path.stat().st_mtime < csv_path.stat().st_mtime:
+        print(f"Tokenizing texts of {csv_path}")
+        token_ids = []
+        for i in tqdm(range(0, len(texts), chunk_size)):
+            token_ids += tokenizer(list(texts[i : i + chunk_size])).input_ids
+
+        offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in token_ids], out=offsets[1:])
+        # written under temporary names and renamed, so that processes started at the same time see complete files
+        for path, array in [
+            (ids_path, np.fromiter((i for ids in token_ids for i in ids), dtype=np.int32, count=offsets[-1])),
+            (offsets_path, offsets),
+        ]:
+            tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    return np.load(ids_path, mmap_mode="r"), np.load(offsets_path, mmap_mode="r")
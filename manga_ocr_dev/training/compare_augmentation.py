@@ -0,0 +1,100 @@
+import time
+
+import fire
+import numpy as np
+import torch
+
+from manga_ocr_dev.training.batch_augment import BatchAugmenter, box_blur
+from manga_ocr_dev.training.dataset import MangaDataset, PackedMangaDataset
+from manga_ocr_dev.training.get_model import get_processor
+
+
+def image_stats(pixel_values, feature_extractor):
+    """
+    Statistics of each image of a batch of pixel values, sensitive to the augmentations: brightness, contrast,
+    edges (blur, sharpen, downscale), fine detail (noise, JPEG compression) and fraction of dark pixels (inversion).
+    """
+    x = pixel_values[:, :1].float() * feature_extractor.image_std[0] + feature_extractor.image_mean[0]
+    size = torch.full((len(x), 2), 3.0)
+    return {
+        "mean": x.mean(dim=(1, 2, 3)),
+        "std": x.std(dim=(1, 2, 3)),
+        "gradient": (x.diff(dim=2).abs().mean(dim=(1, 2, 3)) + x.diff(dim=3).abs().mean(dim=(1, 2, 3))) / 2,
+        "detail": (x - box_blur(x, size)).abs().mean(dim=(1, 2, 3)),
+        "dark": (x < 0.5).float().mean(dim=(1, 2, 3)),
+    }
+
+
+def ks_statistic(a, b):
+    """
+    Two-sample Kolmogorov-Smirnov statistic: largest difference between empirical distribution functions.
+    """
+    values = np.concatenate([a, b])
+    cdf_a = np.searchsorted(np.sort(a), values, side="right") / len(a)
+    cdf_b = np.searchsorted(np.sort(b), values, side="right") / len(b)
+    return np.abs(cdf_a - cdf_b).max()
+
+
+def compare_augmentation(
+    encoder_name="facebook/deit-tiny-patch16-224",
+    decoder_name="cl-tohoku/bert-base-japanese-char-v2",
+    num_samples=1000,
+    batch_size=64,
+    packed_data_root=None,
+):
+    """
+    Compare augmentation of samples by albumentations in dataloader workers with BatchAugmenter, for the medium
+    and heavy policy separately: distributions of image statistics over the same samples, augmented by both,
+    with two-sample Kolmogorov-Smirnov statistic, and time of augmentation per sample.
+
+    :param packed_data_root: Optional directory with packed data, see PackedMangaDataset.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    processor = get_processor(encoder_name, decoder_name)
+    if packed_data_root is None:
+        ds = MangaDataset(processor, "train", 300)
+    else:
+        ds = PackedMangaDataset(processor, "train", 300, packed_data_root)
+    transforms = dict(zip(["medium", "heavy"], ds.get_transforms()))
+
+    indices = np.random.default_rng(0).choice(len(ds), min(num_samples, len(ds)), replace=False)
+    imgs = [ds.load_image(i) for i in indices]
+    image_size = torch.tensor([img.shape[:2] for img in imgs])
+
+    t0 = time.perf_counter()
+    pixel_values = torch.stack([ds.preprocess_image(processor, img) for img in imgs])
+    resize_secs = time.perf_counter() - t0
+
+    for policy, transform in transforms.items():
+        t0 = time.perf_counter()
+        cpu = torch.stack([ds.preprocess_image(processor, img, transform) for img in imgs])
+        cpu_secs = time.perf_counter() - t0 - resize_secs
+
+        augmenter = BatchAugmenter(processor.feature_extractor, *{"medium": (1, 0), "heavy": (0, 1)}[policy])
+        batches = []
+        t0 = time.perf_counter()
+        for i in range(0, len(imgs), batch_size):
+            batch = pixel_values[i : i + batch_size].to(device)
+            batches.append(augmenter(batch, image_size[i : i + batch_size]).cpu())
+        batched_secs = time.perf_counter() - t0
+        batched = torch.cat(batches)
+
+        cpu_stats = image_stats(cpu, processor.feature_extractor)
+        batched_stats = image_stats(batched, processor.feature_extractor)
+        # differences smaller than this are within the noise of samples of this size, at 5% significance
+        critical_value = 1.36 * np.sqrt(2 / len(imgs))
+        print(f"{policy} policy, {len(imgs)} samples, KS critical value at 5%: {critical_value:.3f}")
+        for name in cpu_stats:
+            a, b = cpu_stats[name].numpy(), batched_stats[name].numpy()
+            print(
+                f"{name:<10}workers {a.mean():.4f} ± {a.std():.4f}   batched {b.mean():.4f} ± {b.std():.4f}"
+                f"   KS {ks_statistic(a, b):.3f}"
+            )
+        print(
+            f"augmentation time per sample: workers {1000 * cpu_secs / len(imgs):.3f} ms, "
+            f"batched on {device} {1000 * batched_secs / len(imgs):.3f} ms\n"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(compare_augmentation)
@@ -1,12 +1,19 @@
+import hashlib
+import mmap
+import os
+from pathlib import Path
+
 import albumentations as A
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
+from tqdm import tqdm
 
-from manga_ocr_dev.env import MANGA109_ROOT, DATA_SYNTHETIC_ROOT
+from manga_ocr_dev.env import MANGA109_ROOT, DATA_SYNTHETIC_ROOT, DATA_PACKED_ROOT, EVAL_CACHE_ROOT
+from manga_ocr_dev.training.compact import StringArray, load_token_ids
 
 
 class MangaDataset(Dataset):
@@ -18,11 +25,19 @@ class MangaDataset(Dataset):
         limit_size=None,
         augment=False,
         skip_packages=None,
+        pad_labels=True,
+        batch_augment=False,
     ):
+        """
+        :param pad_labels: If False, labels are only truncated to max_target_length, and padded to the longest ones
+            in a batch by dynamic_padding_collator.
+        :param batch_augment: If True, with augment, images are only converted to grayscale and resized, and returned
+            with their original size as image_size, to be augmented later in batches by BatchAugmenter.
+        """
         self.processor = processor
         self.max_target_length = max_target_length
-
-        data = []
+        self.pad_labels = pad_labels
+        self.batch_augment = batch_augment
 
         print(f"Initializing dataset {split}...")
 
@@ -31,6 +46,21 @@ class MangaDataset(Dataset):
         else:
             skip_packages = {f"{x:04d}" for x in skip_packages}
 
+        # memory-mapped token ids of texts of each csv file, indexed by token_source column
+        self.token_ids = []
+        data = self.load_data(split, skip_packages)
+
+        if limit_size:
+            data = data.iloc[:limit_size]
+        self.set_index(data)
+
+        print(f"Dataset {split}: {len(self)}")
+
+        self.augment = augment
+        self.transform_medium, self.transform_heavy = self.get_transforms()
+
+    def load_data(self, split, skip_packages):
+        data = []
         for path in sorted((DATA_SYNTHETIC_ROOT / "meta").glob("*.csv")):
             if path.stem in skip_packages:
                 print(f"Skipping package {path}")
@@ -38,39 +68,59 @@ class MangaDataset(Dataset):
             if not (DATA_SYNTHETIC_ROOT / "img" / path.stem).is_dir():
                 print(f"Missing image data for package {path}, skipping")
                 continue
-            df = pd.read_csv(path)
+            df = self.add_token_ids(pd.read_csv(path), path)
             df = df.dropna()
             df["path"] = df.id.apply(lambda x: str(DATA_SYNTHETIC_ROOT / "img" / path.stem / f"{x}.jpg"))
-            df = df[["path", "text"]]
+            df = df[["path", "text", "token_source", "token_start", "token_end"]]
             df["synthetic"] = True
             data.append(df)
 
-        df = pd.read_csv(MANGA109_ROOT / "data.csv")
+        df = self.add_token_ids(pd.read_csv(MANGA109_ROOT / "data.csv"), MANGA109_ROOT / "data.csv")
         df = df[df.split == split].reset_index(drop=True)
         df["path"] = df.crop_path.apply(lambda x: str(MANGA109_ROOT / x))
-        df = df[["path", "text"]]
+        df = df[["path", "text", "token_source", "token_start", "token_end"]]
         df["synthetic"] = False
         data.append(df)
 
-        data = pd.concat(data, ignore_index=True)
+        return pd.concat(data, ignore_index=True)
 
-        if limit_size:
-            data = data.iloc[:limit_size]
-        self.data = data
+    def add_token_ids(self, df, csv_path):
+        """
+        Add columns locating token ids of each row's text, loaded with load_token_ids.
+        """
+        token_ids, offsets = load_token_ids(self.processor.tokenizer, df.text.fillna("").astype(str).values, csv_path)
+        df["token_source"] = len(self.token_ids)
+        df["token_start"] = offsets[:-1]
+        df["token_end"] = offsets[1:]
+        self.token_ids.append(token_ids)
+        return df
 
-        print(f"Dataset {split}: {len(self.data)}")
+    def set_index(self, data):
+        """
+        Keep columns of data needed by __getitem__ in compact arrays instead of a DataFrame with Python objects,
+        which dataloader workers would copy.
+        """
+        self.texts = StringArray(data.text.astype(str))
+        self.synthetic = data.synthetic.to_numpy(dtype=bool)
+        self.token_source = data.token_source.to_numpy(dtype=np.int32)
+        self.token_start = data.token_start.to_numpy(dtype=np.int64)
+        self.token_end = data.token_end.to_numpy(dtype=np.int64)
+        self.set_image_index(data)
 
-        self.augment = augment
-        self.transform_medium, self.transform_heavy = self.get_transforms()
+    def set_image_index(self, data):
+        self.paths = StringArray(data.path)
+
+    def image_index(self):
+        """
+        Return arrays identifying images of samples.
+        """
+        return [self.paths.buffer, self.paths.offsets]
 
     def __len__(self):
-        return len(self.data)
+        return len(self.texts)
 
     def __getitem__(self, idx):
-        sample = self.data.loc[idx]
-        text = sample.text
-
-        if self.augment:
+        if self.augment and not self.batch_augment:
             medium_p = 0.8
             heavy_p = 0.02
             transform_variant = np.random.choice(
@@ -85,27 +135,47 @@ class MangaDataset(Dataset):
         else:
             transform = None
 
-        pixel_values = self.read_image(self.processor, sample.path, transform)
-        labels = self.processor.tokenizer(
-            text,
-            padding="max_length",
-            max_length=self.max_target_length,
-            truncation=True,
-        ).input_ids
-        labels = np.array(labels)
-        # important: make sure that PAD tokens are ignored by the loss function
-        labels[labels == self.processor.tokenizer.pad_token_id] = -100
+        img = self.load_image(idx)
+        pixel_values = self.preprocess_image(self.processor, img, transform)
 
         encoding = {
             "pixel_values": pixel_values,
-            "labels": torch.tensor(labels),
+            "labels": torch.from_numpy(self.get_labels(idx)),
         }
+        if self.augment and self.batch_augment:
+            encoding["image_size"] = torch.tensor(img.shape[:2])
         return encoding
 
+    def get_labels(self, idx):
+        """
+        Return token ids of the text, truncated and padded to max_target_length, the same way as by the tokenizer.
+        """
+        token_ids = self.token_ids[self.token_source[idx]][self.token_start[idx] : self.token_end[idx]]
+        if len(token_ids) > self.max_target_length:
+            token_ids = np.append(token_ids[: self.max_target_length - 1], token_ids[-1])
+        if not self.pad_labels:
+            return token_ids.astype(np.int64)
+
+        # important: make sure that PAD tokens are ignored by the loss function
+        labels = np.full(self.max_target_length, -100, dtype=np.int64)
+        labels[: len(token_ids)] = token_ids
+        return labels
+
+    def label_lengths(self):
+        """
+        Return lengths of labels of all samples, without padding.
+        """
+        return np.minimum(self.token_end - self.token_start, self.max_target_length)
+
+    def load_image(self, idx):
+        return cv2.imread(self.paths[idx])
+
     @staticmethod
     def read_image(processor, path, transform=None):
-        img = cv2.imread(str(path))
+        return MangaDataset.preprocess_image(processor, cv2.imread(str(path)), transform)
 
+    @staticmethod
+    def preprocess_image(processor, img, transform=None):
         if transform is None:
             transform = A.ToGray(always_apply=True)
 
@@ -161,6 +231,188 @@ class MangaDataset(Dataset):
         return t_medium, t_heavy
 
 
+class PackedMangaDataset(MangaDataset):
+    """
+    MangaDataset reading images from shards written by manga_ocr_dev/data/pack_dataset.py, memory-mapped,
+    instead of a separate file for each sample. Samples are selected the same way, and kept in order of shards,
+    see ShardShuffleSampler.
+    """
+
+    def __init__(self, processor, split, max_target_length, packed_root=DATA_PACKED_ROOT, **kwargs):
+        self.packed_root = packed_root
+        self.shards = {}
+        super().__init__(processor, split, max_target_length, **kwargs)
+
+    def load_data(self, split, skip_packages):
+        data = pd.read_csv(
+            self.packed_root / "index.csv", dtype={"text": str, "package": str, "split": str}, keep_default_na=False
+        )
+        data = self.add_token_ids(data, self.packed_root / "index.csv")
+        is_synthetic = data.synthetic & ~data.package.isin(skip_packages)
+        is_manga109 = ~data.synthetic & (data.split == split)
+        return data[is_synthetic | is_manga109].reset_index(drop=True)
+
+    def set_image_index(self, data):
+        self.shard = data.shard.to_numpy(dtype=np.int32)
+        self.offset = data.offset.to_numpy(dtype=np.int64)
+        self.size = data["size"].to_numpy(dtype=np.int64)
+
+    def image_index(self):
+        return [np.frombuffer(str(self.packed_root).encode(), dtype=np.uint8), self.shard, self.offset, self.size]
+
+    def load_image(self, idx):
+        # shards are opened lazily, so that each dataloader worker maps them on its own
+        shard = self.shards.get(self.shard[idx])
+        if shard is None:
+            with open(self.packed_root / f"shard_{self.shard[idx]:05d}.bin", "rb") as f:
+                shard = self.shards[self.shard[idx]] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = np.frombuffer(shard, dtype=np.uint8, count=self.size[idx], offset=self.offset[idx])
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+    def __getstate__(self):
+        return {**self.__dict__, "shards": {}}
+
+
+class CachedMangaDataset(Dataset):
+    """
+    MangaDataset without augmentation, e.g. the eval split, whose images are decoded, converted to grayscale
+    and resized by the processor only once. They're stored as uint8 grayscale pixels at the encoder's resolution,
+    in a file memory-mapped afterwards, and only rescaled and normalized when samples are read, giving the same
+    pixel values as the dataset.
+
+    The file is specific to the samples and the processor, and created again if any of them change.
+    """
+
+    def __init__(self, dataset, cache_root=EVAL_CACHE_ROOT, num_workers=0, batch_size=64):
+        """
+        :param dataset: MangaDataset or PackedMangaDataset, without augmentation.
+        :param cache_root: Directory to store preprocessed images in.
+        :param num_workers: Number of dataloader workers preprocessing images when the cache is created.
+        :param batch_size: Number of images preprocessed at once.
+        """
+        if dataset.augment:
+            raise ValueError("Only datasets without augmentation can be cached")
+        self.dataset = dataset
+
+        # the same as rescaling and normalization of the processor: (x * scale - mean) / std == x * weight + bias
+        feature_extractor = dataset.processor.feature_extractor
+        scale = feature_extractor.rescale_factor if feature_extractor.do_rescale else 1.0
+        mean = feature_extractor.image_mean if feature_extractor.do_normalize else [0.0] * 3
+        std = feature_extractor.image_std if feature_extractor.do_normalize else [1.0] * 3
+        self.weight = torch.tensor([scale / s for s in std]).view(3, 1, 1)
+        self.bias = torch.tensor([-m / s for m, s in zip(mean, std)]).view(3, 1, 1)
+
+        md5 = hashlib.md5(feature_extractor.to_json_string().encode())
+        for array in [dataset.texts.buffer, dataset.texts.offsets, *dataset.image_index()]:
+            md5.update(np.ascontiguousarray(array).tobytes())
+        self.path = Path(cache_root) / f"{md5.hexdigest()[:16]}.pixels.npy"
+        if not self.path.is_file():
+            self.create_cache(num_workers, batch_size)
+
+        # memory-mapped lazily, so that each dataloader worker maps it on its own
+        self.pixels = None
+
+    def create_cache(self, num_workers, batch_size):
+        print(f"Caching {len(self.dataset)} preprocessed images in {self.path}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        loader = DataLoader(self.dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=stack_pixel_values)
+
+        # written under a temporary name and renamed, so that processes started at the same time see a complete file
+        tmp_path = self.path.with_name(f"{self.path.stem}.{os.getpid()}.tmp.npy")
+        pixels = None
+        for i, pixel_values in enumerate(tqdm(loader)):
+            if pixels is None:
+                shape = (len(self.dataset), *pixel_values.shape[-2:])
+                pixels = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=shape)
+            # images are grayscale, so the first channel is enough
+            values = (pixel_values[:, 0] - self.bias[0]) / self.weight[0]
+            pixels[i * batch_size : i * batch_size + len(values)] = torch.round(values).clamp(0, 255).byte().numpy()
+        pixels.flush()
+        del pixels
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if self.pixels is None:
+            self.pixels = np.load(self.path, mmap_mode="r")
+        pixels = torch.from_numpy(np.array(self.pixels[idx]))
+        return {
+            "pixel_values": pixels * self.weight + self.bias,
+            "labels": torch.from_numpy(self.dataset.get_labels(idx)),
+        }
+
+    def __getstate__(self):
+        return {**self.__dict__, "pixels": None}
+
+
+def stack_pixel_values(features):
+    return torch.stack([f["pixel_values"] for f in features])
+
+
+class ShardShuffleSampler(Sampler):
+    """
+    Random order of samples of PackedMangaDataset, which reads one shard at a time: shards are shuffled, and samples
+    are shuffled only within their shard, so that reads stay within a few large files instead of jumping between
+    all of them. The order is different in each epoch. Batches are well mixed, because pack_dataset.py shuffles
+    samples across shards.
+    """
+
+    def __init__(self, dataset, seed=0):
+        self.shards = [np.flatnonzero(dataset.shard == shard) for shard in np.unique(dataset.shard)]
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return sum(len(indices) for indices in self.shards)
+
+    def __iter__(self):
+        for i in self.rng.permutation(len(self.shards)):
+            yield from self.rng.permutation(self.shards[i]).tolist()
+
+
+class LengthGroupedSampler(Sampler):
+    """
+    Random order of samples, in which consecutive batches of batch_size samples have labels of similar length,
+    so that little padding is needed with dynamic_padding_collator. Samples are taken in random order, or the order
+    of another sampler, e.g. ShardShuffleSampler, in chunks of megabatch_size batches, which are sorted by length.
+    """
+
+    def __init__(self, lengths, batch_size, sampler=None, megabatch_size=50, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.megabatch_size = megabatch_size
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        order = self.rng.permutation(len(self.lengths)) if self.sampler is None else np.fromiter(self.sampler, int)
+        chunk_size = self.batch_size * self.megabatch_size
+        for i in range(0, len(order), chunk_size):
+            chunk = order[i : i + chunk_size]
+            yield from chunk[np.argsort(-self.lengths[chunk], kind="stable")].tolist()
+
+
+def dynamic_padding_collator(features, pad_to_multiple_of=8):
+    """
+    Collate samples of MangaDataset with pad_labels=False, padding labels with -100 only to the longest ones
+    in the batch, rounded up to a multiple of pad_to_multiple_of. Other fields are stacked.
+    """
+    length = max(len(f["labels"]) for f in features)
+    length = -(-length // pad_to_multiple_of) * pad_to_multiple_of
+
+    labels = torch.full((len(features), length), -100, dtype=torch.long)
+    for i, f in enumerate(features):
+        labels[i, : len(f["labels"])] = f["labels"]
+
+    batch = {key: torch.stack([f[key] for f in features]) for key in features[0] if key != "labels"}
+    batch["labels"] = labels
+    return batch
+
+
 if __name__ == "__main__":
     from manga_ocr_dev.training.get_model import get_processor
     from manga_ocr_dev.training.utils import tensor_to_image
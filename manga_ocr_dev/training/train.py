@@ -1,13 +1,47 @@
+from pathlib import Path
+
 import fire
 import wandb
 from transformers import Seq2SeqTrainer, Seq2SeqTrainingArguments, default_data_collator
 
 from manga_ocr_dev.env import TRAIN_ROOT
-from manga_ocr_dev.training.dataset import MangaDataset
+from manga_ocr_dev.training.batch_augment import BatchAugmenter
+from manga_ocr_dev.training.dataset import (
+    CachedMangaDataset,
+    LengthGroupedSampler,
+    MangaDataset,
+    PackedMangaDataset,
+    ShardShuffleSampler,
+    dynamic_padding_collator,
+)
 from manga_ocr_dev.training.get_model import get_model
 from manga_ocr_dev.training.metrics import Metrics
 
 
+class MangaTrainer(Seq2SeqTrainer):
+    """
+    Seq2SeqTrainer with an optional custom sampler of training data, and optional augmentation of training batches
+    on the device, after they're moved there.
+    """
+
+    def __init__(self, *args, train_sampler=None, augmenter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_sampler = train_sampler
+        self.augmenter = augmenter
+
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.train_sampler is not None:
+            return self.train_sampler
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        # only samples of MangaDataset with batch_augment have image_size
+        if self.augmenter is not None and "image_size" in inputs:
+            inputs = dict(inputs)
+            inputs["pixel_values"] = self.augmenter(inputs["pixel_values"], inputs.pop("image_size"))
+        return super().compute_loss(model, inputs, *args, **kwargs)
+
+
 def run(
     run_name="debug",
     encoder_name="facebook/deit-tiny-patch16-224",
@@ -17,14 +51,66 @@ def run(
     batch_size=64,
     num_epochs=8,
     fp16=True,
+    packed_data_root=None,
+    dynamic_padding=False,
+    batch_augment=False,
+    cache_eval=True,
 ):
     wandb.login()
 
     model, processor = get_model(encoder_name, decoder_name, max_len, num_decoder_layers)
 
-    # keep package 0 for validation
-    train_dataset = MangaDataset(processor, "train", max_len, augment=True, skip_packages=[0])
-    eval_dataset = MangaDataset(processor, "test", max_len, augment=False, skip_packages=range(1, 9999))
+    # with dynamic padding, labels are padded only to the longest ones in a batch, instead of max_len,
+    # and batches are made of samples with labels of similar length
+    pad_labels = not dynamic_padding
+    # with batch augmentation, dataloader workers only decode and resize images, and batches are augmented on the GPU
+    augmenter = BatchAugmenter(processor.feature_extractor) if batch_augment else None
+
+    train_sampler = None
+    if packed_data_root is None:
+        # keep package 0 for validation
+        train_dataset = MangaDataset(
+            processor,
+            "train",
+            max_len,
+            augment=True,
+            skip_packages=[0],
+            pad_labels=pad_labels,
+            batch_augment=batch_augment,
+        )
+        eval_dataset = MangaDataset(
+            processor, "test", max_len, augment=False, skip_packages=range(1, 9999), pad_labels=pad_labels
+        )
+    else:
+        # data packed by manga_ocr_dev/data/pack_dataset.py, read from large shards instead of separate image files
+        packed_data_root = Path(packed_data_root)
+        train_dataset = PackedMangaDataset(
+            processor,
+            "train",
+            max_len,
+            packed_data_root,
+            augment=True,
+            skip_packages=[0],
+            pad_labels=pad_labels,
+            batch_augment=batch_augment,
+        )
+        eval_dataset = PackedMangaDataset(
+            processor,
+            "test",
+            max_len,
+            packed_data_root,
+            augment=False,
+            skip_packages=range(1, 9999),
+            pad_labels=pad_labels,
+        )
+        train_sampler = ShardShuffleSampler(train_dataset)
+
+    if cache_eval:
+        # images of the eval split are preprocessed once, instead of at every evaluation
+        eval_dataset = CachedMangaDataset(eval_dataset, num_workers=16)
+
+    if dynamic_padding:
+        train_sampler = LengthGroupedSampler(train_dataset.label_lengths(), batch_size, train_sampler)
 
     metrics = Metrics(processor)
 
@@ -46,14 +132,16 @@ def run(
     )
 
     # instantiate trainer
-    trainer = Seq2SeqTrainer(
+    trainer = MangaTrainer(
         model=model,
         tokenizer=processor.feature_extractor,
         args=training_args,
         compute_metrics=metrics.compute_metrics,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
-        data_collator=default_data_collator,
+        data_collator=dynamic_padding_collator if dynamic_padding else default_data_collator,
+        train_sampler=train_sampler,
+        augmenter=augmenter,
     )
     trainer.train()
 
@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from manga_ocr import MangaOcr
+from tests.utils import TEST_DATA_ROOT, make_page
+
+
+@pytest.fixture
+def page():
+    return make_page()
+
+
+@pytest.fixture(scope="module")
+def expected_results():
+    return json.loads((TEST_DATA_ROOT / "expected_results.json").read_text(encoding="utf-8"))
+
+
+@pytest.fixture(scope="module")
+def image_paths(expected_results):
+    return [TEST_DATA_ROOT / "images" / item["filename"] for item in expected_results]
+
+
+@pytest.fixture(scope="module")
+def mocr():
+    return MangaOcr()
+
+
+@pytest.fixture(scope="module")
+def mocr_greedy():
+    return MangaOcr(decoding="greedy")
@@ -0,0 +1,16 @@
+from PIL import Image
+
+from manga_ocr.clipboard import ClipboardMonitor
+
+
+def test_clipboard_monitor():
+    clipboard = ClipboardMonitor()
+    img = Image.new("RGB", (1920, 1080), "white")
+
+    assert clipboard.is_new_image(img)
+    assert not clipboard.is_new_image(img.copy())
+    assert clipboard.is_new_image(img.crop((0, 0, 1919, 1080)))
+
+    # copying the same image again after something else is noticed
+    assert not clipboard.is_new_image(None)
+    assert clipboard.is_new_image(img)
@@ -0,0 +1,18 @@
+import numpy as np
+
+from manga_ocr.detection import detect_text_regions
+
+
+def iou(a, b):
+    intersection = max(0, min(a[2], b[2]) - max(a[0], b[0])) * max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    return intersection / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection)
+
+
+def test_detect_text_regions(page):
+    page, expected_boxes = page
+
+    boxes = detect_text_regions(np.asarray(page))
+
+    assert len(boxes) == len(expected_boxes)
+    for box, expected_box in zip(boxes, expected_boxes):
+        assert iou(box, expected_box) > 0.5
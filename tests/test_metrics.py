@@ -0,0 +1,27 @@
+import json
+
+from manga_ocr.metrics import OcrMetrics
+
+
+def test_metrics():
+    observations = []
+    metrics = OcrMetrics(callback=lambda name, value: observations.append(name))
+
+    with metrics.time("encoder"):
+        pass
+    metrics.observe_stage("decoder_step", 0.002)
+    metrics.observe_stage("decoder_step", 0.004)
+    metrics.observe_batch([3, 5])
+
+    assert observations == ["encoder", "decoder_step", "decoder_step", "batches", "images", "generated_tokens"]
+
+    data = json.loads(metrics.to_json())
+    assert data["stages"]["decoder_step"]["count"] == 2
+    assert abs(data["stages"]["decoder_step"]["mean"] - 0.003) < 1e-9
+    assert data["counters"]["images"] == 2 and data["counters"]["generated_tokens"] == 8
+    assert data["batch_sizes"]["count"] == 1
+
+    text = metrics.render_prometheus()
+    assert 'manga_ocr_stage_duration_seconds_bucket{stage="decoder_step",le="0.0025"} 1' in text
+    assert 'manga_ocr_stage_duration_seconds_count{stage="decoder_step"} 2' in text
+    assert "manga_ocr_generated_tokens_total 8" in text
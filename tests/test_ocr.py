@@ -1,16 +1,178 @@
-import json
-from pathlib import Path
+import asyncio
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
 
 from manga_ocr import MangaOcr
+from manga_ocr.cache import OcrCache
+from manga_ocr.metrics import OcrMetrics
+from manga_ocr.ocr import post_process, post_process_partial
+from manga_ocr.onnx_backend import export_onnx
+from manga_ocr.quantization import get_quantized_model_path
+from tests.utils import edit_distance
+
+
+def test_ocr(mocr, expected_results, image_paths):
+    for item, path in zip(expected_results, image_paths):
+        assert mocr(path) == item["result"]
+
+
+def test_ocr_batch(mocr, expected_results, image_paths):
+    results = mocr.batch(image_paths, batch_size=5)
+    assert results == [item["result"] for item in expected_results]
+
+    results = mocr.batch(image_paths, batch_size=5, sort_by_length=True)
+    assert results == [item["result"] for item in expected_results]
+
+
+def test_ocr_greedy(mocr_greedy, image_paths):
+    results = mocr_greedy.batch(image_paths, batch_size=5)
+    # any setting not handled by greedy_decode makes it fall back to generate()
+    assert results == mocr_greedy.batch(image_paths, batch_size=5, early_stopping=False)
+
+
+def test_ocr_continuous_batching(mocr_greedy, image_paths):
+    results = [mocr_greedy(path) for path in image_paths]
+    # finished texts are replaced in the batch by waiting images, which doesn't change results
+    assert mocr_greedy.batch(image_paths, batch_size=3) == results
+    assert (
+        mocr_greedy.batch(image_paths, batch_size=3, drafts=[text[: i % 4] for i, text in enumerate(results)])
+        == results
+    )
+
+
+def test_ocr_draft(mocr_greedy, image_paths):
+    mocr, paths = mocr_greedy, image_paths
+    num_drafts = mocr.draft_stats["drafts"]
+
+    results = mocr.batch(paths)
+    # results don't depend on drafts, whether they are right, wrong or missing
+    assert mocr.batch(paths, drafts=results) == results
+    assert mocr.batch(paths, drafts=[text[:3] + "あ" + text[4:] for text in results]) == results
+    assert [mocr(path, draft=None if i % 2 else text) for i, (path, text) in enumerate(zip(paths, results))] == results
+
+    assert mocr.draft_stats["drafts"] - num_drafts == 2 * len(paths) + len(paths) // 2
+    assert mocr.draft_stats["accepted_tokens"] > 0
+
+
+def test_ocr_draft_poisoned_cache(mocr_greedy, image_paths, monkeypatch):
+    results = mocr_greedy.batch(image_paths)
+
+    step = mocr_greedy._decoder_step
+    forward_cached = step.forward_cached
+
+    def poisoned_forward_cached(input_ids, positions, cross_kv, kv_cache):
+        # slots of the cache, which weren't written yet, may hold anything
+        if isinstance(positions, int) and positions == 0:
+            for x in kv_cache:
+                x.fill_(float("nan"))
+        return forward_cached(input_ids, positions, cross_kv, kv_cache)
+
+    monkeypatch.setattr(step, "forward_cached", poisoned_forward_cached)
+    # drafts of different lengths leave rows at different positions, so that shorter rows skip slots of longer ones
+    assert mocr_greedy.batch(image_paths, drafts=[text[: i % 4] for i, text in enumerate(results)]) == results
+
+
+def test_ocr_cache(expected_results, image_paths):
+    mocr = MangaOcr(cache=OcrCache(keep_encoder_outputs=True))
+
+    for _ in range(2):
+        for item, path in zip(expected_results, image_paths):
+            assert mocr(path) == item["result"]
+
+    assert mocr.cache.hits == len(expected_results)
+    assert mocr.cache.misses == len(expected_results)
+
+    # results of a different variant of the model aren't reused
+    MangaOcr(cache=mocr.cache, quantize="int8")(image_paths[0])
+    assert mocr.cache.misses == len(expected_results) + 1
+
+
+def test_ocr_metrics(image_paths):
+    mocr = MangaOcr(metrics=OcrMetrics(), decoding="greedy")
+
+    mocr.batch(image_paths, batch_size=5)
+
+    stages = mocr.metrics.to_dict()["stages"]
+    for stage in ["load", "grayscale", "resize", "transfer", "normalize", "encoder", "decode", "post_process"]:
+        assert stages[stage]["count"] > 0
+    assert mocr.metrics.counters["images"] == len(image_paths)
+    assert stages["decoder_step"]["count"] > stages["decode"]["count"]
+
+
+def test_ocr_quantized(expected_results, image_paths):
+    results = MangaOcr(quantize="int8").batch(image_paths)
+    assert get_quantized_model_path("kha-white/manga-ocr-base").is_file()
+    # the second time, the quantized model is loaded from cache
+    assert MangaOcr(quantize="int8").batch(image_paths) == results
+
+    errors = sum(edit_distance(text, item["result"]) for text, item in zip(results, expected_results))
+    assert errors / sum(len(item["result"]) for item in expected_results) < 0.05
+
+
+def test_ocr_threads(expected_results, image_paths):
+    cpus = sorted(os.sched_getaffinity(0))[:2] if hasattr(os, "sched_getaffinity") else None
+    mocr = MangaOcr(num_threads=2, cpu_affinity=cpus)
+
+    paths = image_paths
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(mocr, paths))
+        batch_results = list(
+            executor.map(lambda i: mocr.batch(paths[i : i + 3], batch_size=2), range(0, len(paths), 3))
+        )
+    assert results == [item["result"] for item in expected_results]
+    assert list(itertools.chain.from_iterable(batch_results)) == results
+
+
+def test_ocr_async(expected_results, image_paths):
+    mocr = MangaOcr(metrics=OcrMetrics())
+    paths = image_paths
+
+    async def recognize():
+        cancelled = asyncio.ensure_future(mocr.aocr(paths[0]))
+        results = asyncio.gather(*[mocr.aocr(path) for path in paths])
+        cancelled.cancel()
+        return await results, [text async for text in mocr.aocr_iter(paths, max_pending=4)]
+
+    results, iter_results = asyncio.run(recognize())
+    assert results == [item["result"] for item in expected_results]
+    assert iter_results == [item["result"] for item in expected_results]
+    # concurrent images are recognized together, and the cancelled one is skipped
+    assert mocr.metrics.counters["batches"] < len(paths)
+    assert mocr.metrics.counters["images"] == 2 * len(paths)
+
+
+def test_ocr_stream(mocr_greedy, image_paths):
+    for path in image_paths:
+        texts = list(mocr_greedy.stream(path))
+        assert texts[-1] == mocr_greedy(path)
+        assert all(texts[-1].startswith(text) for text in texts)
+        if len(texts[-1]) > 10:
+            assert len(texts) > 1
+
+
+def test_post_process_partial():
+    text = "ｶﾞ ﾝ・・と 12...ﾊﾟ…ﾝ！"
+    for i in range(len(text) + 1):
+        assert post_process(text).startswith(post_process_partial(text[:i]))
+    assert post_process_partial(text) == post_process(text)
+
+
+def test_ocr_onnx(tmp_path, expected_results, image_paths):
+    pytest.importorskip("onnxruntime")
 
-TEST_DATA_ROOT = Path(__file__).parent / "data"
+    export_onnx(tmp_path)
+    mocr = MangaOcr(tmp_path, backend="onnx")
 
+    for item, path in zip(expected_results, image_paths):
+        assert mocr(path) == item["result"]
 
-def test_ocr():
-    mocr = MangaOcr()
 
-    expected_results = json.loads((TEST_DATA_ROOT / "expected_results.json").read_text(encoding="utf-8"))
+def test_read_page(mocr, page):
+    page, boxes = page
+    results = mocr.read_page(page, batch_size=2)
 
-    for item in expected_results:
-        result = mocr(TEST_DATA_ROOT / "images" / item["filename"])
-        assert result == item["result"]
+    assert [result["text"] for result in results] == mocr.batch([page.crop(result["box"]) for result in results])
+    assert len(results) == len(boxes)
@@ -0,0 +1,15 @@
+from manga_ocr.pipeline import OcrPipeline
+
+
+def test_pipeline(tmp_path, mocr, expected_results, image_paths):
+    output_path = tmp_path / "output.txt"
+    with OcrPipeline(mocr, output_path, batch_size=4) as pipeline:
+        for i, path in enumerate(image_paths):
+            pipeline.put(path)
+            if i == 1:
+                # items which can't be read are skipped
+                pipeline.put(path.with_name("missing.jpg"))
+                pipeline.put(None)
+
+    results = output_path.read_text(encoding="utf-8").splitlines()
+    assert results == [item["result"] for item in expected_results]
@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+from manga_ocr.pool import MangaOcrPool
+
+
+def mapped_memory(pid, path):
+    """
+    Sum memory stats in kB of all mappings of a file in a process, from /proc/<pid>/smaps.
+    """
+    stats = {"Rss": 0, "Pss": 0, "Private_Dirty": 0}
+    in_mapping = False
+    for line in Path(f"/proc/{pid}/smaps").read_text().splitlines():
+        fields = line.split()
+        if "-" in fields[0]:
+            in_mapping = fields[-1] == str(path)
+        elif in_mapping and fields[0].rstrip(":") in stats:
+            stats[fields[0].rstrip(":")] += int(fields[1])
+    return stats
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="memory stats are read from /proc")
+def test_pool_shared_memory(expected_results, image_paths):
+    with MangaOcrPool(num_workers=2) as pool:
+        assert pool.map(image_paths) == [item["result"] for item in expected_results]
+
+        weights_size = pool.weights_path.stat().st_size // 1024
+        for pid in pool.pids:
+            stats = mapped_memory(pid, pool.weights_path.resolve())
+            # each worker has all the weights mapped, but pays only for its share of them, and copies none
+            assert stats["Rss"] > 0.9 * weights_size
+            assert stats["Pss"] < 0.6 * stats["Rss"]
+            assert stats["Private_Dirty"] < 0.01 * stats["Rss"]
@@ -0,0 +1,39 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from manga_ocr.preprocessing import GrayscalePreprocessor
+
+try:
+    # transformers>=5 resizes with torchvision if it's installed, models were trained with PIL resizing
+    from transformers import ViTImageProcessorPil as ViTImageProcessor
+except ImportError:
+    from transformers import ViTImageProcessor
+
+TEST_DATA_ROOT = Path(__file__).parent / "data"
+
+
+def test_grayscale_preprocessor():
+    # settings of kha-white/manga-ocr-base
+    processor = ViTImageProcessor(size={"height": 224, "width": 224}, image_mean=[0.5] * 3, image_std=[0.5] * 3)
+    preprocessor = GrayscalePreprocessor(processor)
+
+    imgs = [Image.open(path).convert("L") for path in sorted((TEST_DATA_ROOT / "images").iterdir())]
+    expected = processor([img.convert("RGB") for img in imgs], return_tensors="pt").pixel_values
+
+    x = preprocessor(imgs)
+    assert x.shape == expected.shape and x.dtype == torch.float32
+    assert torch.allclose(x, expected, atol=1e-6)
+
+    # crops of an array, which are views with strides of the whole page
+    page = np.full((1000, 1500), 255, dtype=np.uint8)
+    page[100 : 100 + imgs[0].height, 200 : 200 + imgs[0].width] = np.asarray(imgs[0])
+    crop = page[100 : 100 + imgs[0].height, 200 : 200 + imgs[0].width]
+    assert torch.allclose(preprocessor([crop, imgs[1]]), expected[:2], atol=1e-6)
+
+    # color images are converted to grayscale the same way as by MangaOcr before
+    img = Image.open(TEST_DATA_ROOT / "images" / "00.jpg").convert("RGB")
+    expected = processor(img.convert("L").convert("RGB"), return_tensors="pt").pixel_values
+    assert torch.allclose(preprocessor([img]), expected, atol=1e-6)
@@ -0,0 +1,82 @@
+import asyncio
+import base64
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from manga_ocr.server import OcrServer
+
+
+def post(url, data, content_type):
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": content_type})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def start(server):
+    """
+    Start the server in an event loop in a background thread, and return the loop and the server's URL.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio_server = asyncio.run_coroutine_threadsafe(server.start(port=0), loop).result()
+    return loop, f"http://127.0.0.1:{asyncio_server.sockets[0].getsockname()[1]}"
+
+
+def stop(server, loop):
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def test_server(mocr, expected_results, image_paths):
+    server = OcrServer(mocr, batch_size=4, max_wait_ms=50)
+    loop, url = start(server)
+
+    files = [path.read_bytes() for path in image_paths]
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda file: post(f"{url}/ocr", file, "image/jpeg")["text"], files))
+    assert results == [item["result"] for item in expected_results]
+
+    data = json.dumps({"images": [base64.b64encode(file).decode() for file in files]}).encode()
+    assert post(f"{url}/ocr", data, "application/json")["texts"] == [item["result"] for item in expected_results]
+
+    with urllib.request.urlopen(f"{url}/metrics") as response:
+        metrics = response.read().decode()
+    assert f'manga_ocr_responses_total{{code="200"}} {len(files) + 1}' in metrics
+    assert f"manga_ocr_request_duration_seconds_count {len(files) + 1}" in metrics
+    assert f"manga_ocr_server_batch_size_sum {2.0 * len(files)}" in metrics
+
+    stop(server, loop)
+
+
+def test_server_errors(mocr, image_paths, monkeypatch):
+    server = OcrServer(mocr, batch_size=4, max_queue_size=4)
+    loop, url = start(server)
+    host, port = url.removeprefix("http://").split(":")
+
+    with socket.create_connection((host, int(port))) as sock:
+        sock.sendall(b"GET\r\n\r\n")
+        assert sock.makefile("rb").readline().split()[1] == b"400"
+
+    files = [path.read_bytes() for path in image_paths[:5]]
+    data = json.dumps({"images": [base64.b64encode(file).decode() for file in files]}).encode()
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(f"{url}/ocr", data, "application/json")
+    assert e.value.code == 413
+
+    monkeypatch.setattr(server, "_decode_images", lambda files: 1 / 0)
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(f"{url}/ocr", files[0], "image/jpeg")
+    assert e.value.code == 500
+    monkeypatch.undo()
+
+    # the server keeps working after an unexpected error
+    assert post(f"{url}/ocr", files[0], "image/jpeg")["text"] == mocr(image_paths[0])
+
+    stop(server, loop)
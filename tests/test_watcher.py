@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+from manga_ocr.watcher import DirectoryWatcher
+
+
+def poll_until_ready(watcher, count, timeout=5.0):
+    ready = []
+    deadline = time.monotonic() + timeout
+    while len(ready) < count and time.monotonic() < deadline:
+        ready += watcher.poll()
+    return sorted(ready)
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_directory_watcher(tmp_path, use_inotify):
+    (tmp_path / "old.png").write_bytes(b"old")
+
+    with DirectoryWatcher(tmp_path, delay_secs=0.05, max_seen=3, use_inotify=use_inotify) as watcher:
+        # partially written file isn't reported until it stops changing
+        with (tmp_path / "a.png").open("wb") as f:
+            for _ in range(3):
+                f.write(b"a")
+                f.flush()
+                assert watcher.poll() == []
+        (tmp_path / "b.png").write_bytes(b"b")
+        assert poll_until_ready(watcher, 2) == [tmp_path / "a.png", tmp_path / "b.png"]
+
+        # files are reported once, but again after being modified
+        (tmp_path / "c.png").write_bytes(b"c")
+        assert poll_until_ready(watcher, 1) == [tmp_path / "c.png"]
+        time.sleep(0.01)
+        (tmp_path / "a.png").write_bytes(b"aaa")
+        assert poll_until_ready(watcher, 1) == [tmp_path / "a.png"]
+
+        # forgotten files aren't reported again by a full scan
+        (tmp_path / "d.png").write_bytes(b"d")
+        assert poll_until_ready(watcher, 1) == [tmp_path / "d.png"]
+        assert tmp_path / "b.png" not in watcher.seen
+        watcher._scan()
+        assert not watcher.pending
+
+
+def test_directory_watcher_moved_files(tmp_path):
+    watched = tmp_path / "watched"
+    watched.mkdir()
+
+    with DirectoryWatcher(watched, delay_secs=0.05, max_seen=1, use_inotify=False) as watcher:
+        # a file moved in keeps its mtime from before the watcher was created
+        (tmp_path / "a.png").write_bytes(b"a")
+        os.utime(tmp_path / "a.png", ns=(0, 0))
+        (tmp_path / "a.png").rename(watched / "a.png")
+        assert poll_until_ready(watcher, 1) == [watched / "a.png"]
+
+        # and isn't reported again after being forgotten
+        (watched / "b.png").write_bytes(b"b")
+        assert poll_until_ready(watcher, 1) == [watched / "b.png"]
+        assert watched / "a.png" not in watcher.seen
+        watcher._scan()
+        assert not watcher.pending
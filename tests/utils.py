@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+TEST_DATA_ROOT = Path(__file__).parent / "data"
+
+
+def edit_distance(a, b):
+    row = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        prev, row[0] = row[0], i
+        for j, cb in enumerate(b, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (ca != cb))
+    return row[-1]
+
+
+def make_page():
+    """
+    Synthetic manga page made of test images: text on light background in reading order,
+    among panel borders, text on dark background (which isn't detected), and a screentone.
+    Returns the page and boxes of the text images.
+    """
+    page = Image.new("L", (1170, 1654), 255)
+    draw = ImageDraw.Draw(page)
+    for panel in [(40, 40, 1130, 560), (40, 590, 560, 1130), (590, 590, 1130, 1130), (40, 1160, 1130, 1614)]:
+        draw.rectangle(panel, outline=0, width=5)
+
+    for name, position in [("01", (80, 80)), ("07", (80, 850)), ("05", (700, 1200)), ("08", (900, 700))]:
+        page.paste(Image.open(TEST_DATA_ROOT / "images" / f"{name}.jpg").convert("L"), position)
+
+    yy, xx = np.mgrid[:300, :400]
+    screentone = np.where((yy % 6 < 2) & (xx % 6 < 2), 60, 255).astype(np.uint8)
+    page.paste(Image.fromarray(screentone), (450, 1250))
+
+    boxes = []
+    for name, (x, y) in [
+        ("11", (820, 120)),
+        ("09", (560, 150)),
+        ("02", (150, 650)),
+        ("10", (720, 1000)),
+        ("00", (200, 1300)),
+    ]:
+        img = Image.open(TEST_DATA_ROOT / "images" / f"{name}.jpg").convert("L")
+        page.paste(img, (x, y))
+        boxes.append((x, y, x + img.width, y + img.height))
+
+    return page, boxes